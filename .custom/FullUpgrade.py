@@ -11,15 +11,194 @@ import time
 import shutil
 from datetime import datetime
 from pathlib import Path
-import urllib.request
-from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import fnmatch
+import json
+import queue
+import re
+import signal
+import threading
+from collections import deque
+
+# asyncio, concurrent.futures, http.client, sqlite3, urllib and the like
+# are imported by the functions that use them, so that a quick
+# subcommand only pays for what it runs
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+PACMAN_D = "/etc/pacman.d"
+ARCH_MIRRORLIST_URL = "https://archlinux.org/mirrorlist/all/https/"
+CACHE_DIR = "/var/cache/fullupgrade"
+MIRRORLIST_CACHE = f"{CACHE_DIR}/mirrorlist.all"
+
+# "native" probes mirrors concurrently in-process, "rankmirrors" shells out
+MIRROR_RANKER = "native"
+MIRROR_CONCURRENCY = 32
+MIRROR_PROBE_REPO = "core"
+MIRROR_PROBE_ARCH = os.uname().machine
+
+# "throughput" ranks on a ranged fetch over pooled keep-alive connections,
+# "latency" on the time to download the small probe database
+MIRROR_PROBE_MODE = "throughput"
+MIRROR_THROUGHPUT_REPO = "extra"
+MIRROR_THROUGHPUT_BYTES = 2 * 1024 * 1024
+MIRROR_THROUGHPUT_SAMPLES = 2
+# Throughput is only sampled on a latency shortlist of the best mirrors
+# plus this many, a few at a time so that probes do not share the link
+MIRROR_SHORTLIST_EXTRA = 5
+MIRROR_THROUGHPUT_CONCURRENCY = 2
+# A throughput probe gets the latency timeout plus the time to fetch
+# its samples at this rate (bytes per second) before it is abandoned
+MIRROR_THROUGHPUT_MIN_RATE = 1024 * 1024
+# Mirrors are scored by the estimated seconds to fetch this much data
+MIRROR_SCORE_PAYLOAD = 256 * 1024 * 1024
+
+# Mirror history: later runs only re-probe the best known mirrors, stale
+# entries and a small random exploration sample
+STATE_DIR = "/var/lib/fullupgrade"
+MIRROR_HISTORY_DB = f"{STATE_DIR}/mirrors.sqlite3"
+MIRROR_HISTORY_DECAY = 0.5  # weight of the newest sample in the score
+MIRROR_STALE_AFTER = 7 * 24 * 3600
+# Throughput measured less than this long ago is reused instead of
+# fetching the samples again; only the latency sweep is repeated
+MIRROR_THROUGHPUT_MAX_AGE = 24 * 3600
+MIRROR_FULL_SWEEP_AFTER = 30 * 24 * 3600
+MIRROR_EXPLORE = 10
+# Seconds before a mirror ranking task is killed
+MIRROR_TASK_TIMEOUT = 300
+
+PACMAN_LOCAL_DB = "/var/lib/pacman/local"
+MISSING_FILES_REPORT = "/tmp/missing_files_report.txt"
+# Integrity checks run sharded across this many pacman processes;
+# INTEGRITY_DEEP uses -Qkk (checksums/permissions) instead of -Qk
+INTEGRITY_WORKERS = os.cpu_count() or 4
+INTEGRITY_DEEP = False
+
+# Download the pacman upgrade (pacman -Syuw) in the background as soon
+# as the mirrorlist is settled, so pacman() installs from a warm cache
+PACMAN_PREFETCH = True
+
+# Package cache pruning, like paccache -r -u: the newest PKG_CACHE_KEEP
+# versions of uninstalled packages are kept. Installed packages are left
+# alone unless PKG_CACHE_KEEP_INSTALLED is set to a number of versions.
+PKG_CACHE_DIR = "/var/cache/pacman/pkg"
+PKG_CACHE_KEEP = 3
+PKG_CACHE_KEEP_INSTALLED = None
+
+# AUR update check: foreign packages are looked up AUR_RPC_BATCH at a
+# time and the answers reused for AUR_CACHE_TTL seconds
+AUR_RPC_URL = "https://aur.archlinux.org/rpc/v5/info"
+AUR_RPC_BATCH = 150
+AUR_CACHE = f"{CACHE_DIR}/aur-info.json"
+AUR_CACHE_TTL = 15 * 60
+
+LOG_ROOT = "/var/log"
+# Active logs above the budget keep only their newest LOG_SIZE_BUDGET
+# bytes; the older part is gzipped to <log>.1.gz when compressing
+LOG_SIZE_BUDGET = 4 * 1024 * 1024
+LOG_ROTATE_COMPRESS = True
+
+# The journal is only vacuumed (down to JOURNAL_VACUUM_TARGET bytes)
+# when it exceeds JOURNAL_BUDGET or, if set, holds files older than
+# JOURNAL_RETENTION seconds
+JOURNAL_DIR = f"{LOG_ROOT}/journal"
+JOURNAL_BUDGET = 64 * 1024 * 1024
+JOURNAL_VACUUM_TARGET = 10 * 1024 * 1024
+JOURNAL_RETENTION = None
+
+# Coredump/temp cleanup. Each top-level entry of a policy's dirs is
+# removed by the first policy of that dir whose age (seconds since the
+# newest file), size and name patterns all match.
+CLEANUP_POLICIES = [
+    {
+        "name": "coredumps",
+        "dirs": ["/var/lib/systemd/coredump", "/var/crash", "/var/dumps"],
+    },
+    {"name": "stale-var-tmp", "dirs": ["/var/tmp"], "min_age": 30 * 86400},
+    {"name": "stale-tmp", "dirs": ["/tmp"], "min_age": 10 * 86400},
+]
+CLEANUP_EXCLUDE = [
+    "systemd-private-*",
+    ".X*-unix",
+    ".X*-lock",
+    ".ICE-unix",
+    ".font-unix",
+    ".XIM-unix",
+    ".Test-unix",
+]
+
+# Package manifests kept next to this script's directory (~/.crucial)
+MANIFEST_DIR = str(Path(__file__).resolve().parent.parent / ".crucial")
+MANIFEST_FILES = ["pkglist.txt", "ExplicitPkg_list.txt"]
+MANIFEST_SNAPSHOT = f"{STATE_DIR}/manifest.json"
+
+# Per-run performance reports; a phase is flagged when it takes more
+# than PERF_REGRESSION_FACTOR times (and PERF_REGRESSION_MIN_SECONDS
+# longer than) its median over the last PERF_HISTORY_RUNS runs
+PERF_DIR = f"{STATE_DIR}/perf"
+PERF_HISTORY_RUNS = 10
+PERF_REGRESSION_FACTOR = 2
+PERF_REGRESSION_MIN_SECONDS = 30
+
+# Update detection: phases whose cheap check finds nothing pending are
+# skipped. Pacman is checked against a private copy of the sync
+# databases (like checkupdates); firmware metadata younger than
+# FWUPD_METADATA_MAX_AGE seconds is not refreshed again.
+REFRESH_STATE = f"{STATE_DIR}/refresh.json"
+CHECKUPDATES_DB = f"{CACHE_DIR}/checkup-db"
+FWUPD_METADATA_DIR = "/var/lib/fwupd/metadata"
+FWUPD_METADATA_MAX_AGE = 24 * 3600
+
+# Checkpoints of the last run, for --resume; an unfinished run older
+# than RESUME_MAX_AGE seconds is not resumed
+RUN_JOURNAL = f"{STATE_DIR}/journal.json"
+RESUME_MAX_AGE = 12 * 3600
+
+# Upgrade phases that may run at the same time
+PHASE_WORKERS = 4
+
+# Answer profile read by --unattended when --answers is not given
+ANSWERS_FILE = "/etc/fullupgrade/answers.json"
+
+# Machine-readable JSON Lines logs, one file per run
+LOG_DIR = "/var/log/fullupgrade"
+# Seconds the log writer gets to drain after Ctrl-C before the rest of
+# the log is written past a prompt that still holds the terminal
+LOG_INTERRUPT_FLUSH = 2
+
+# Streamed command output: the newest stderr lines repeated when the
+# command fails, and how much of the full capture stays in memory
+# before spilling to disk
+OUTPUT_TAIL_LINES = 20
+OUTPUT_SPOOL_BYTES = 1024 * 1024
+# Streamed lines the log writer may fall behind by (e.g. while a prompt
+# holds the terminal) before further ones are only counted, not shown
+LOG_QUEUE_LINES = 5000
 
 # ============================================================
 # GLOBAL STATE FOR PROCESS MANAGEMENT
 # ============================================================
 
-futures = []
-executor = None
+# Name of the phase running on the current thread, for log attribution
+_phase_local = threading.local()
+# Held while prompting or while a command owns the terminal
+_terminal_lock = threading.RLock()
+
+# Preset answers by question key, and whether to never prompt
+_answers = {}
+_unattended = False
+
+# Set once the prefetch phase has synced the private databases and
+# downloaded every package of the upgrade
+_prefetched = threading.Event()
+
+# Update check results by source for this run, and whether phases with
+# nothing pending are skipped
+_pending_work = {}
+_refresh_lock = threading.Lock()
+_skip_up_to_date = True
 
 
 # ============================================================
@@ -27,28 +206,359 @@ executor = None
 # ============================================================
 
 
+class LogWriter:
+    """
+    Queue-backed log writer. Callers only enqueue; a daemon thread
+    writes the human-readable lines to the terminal and, when enabled,
+    a JSON Lines record with a monotonic timestamp and phase tag.
+
+    Human output waits while a prompt or an interactive command owns
+    the terminal. With `paced`, the writer thread (never the caller)
+    pauses after info and error lines so they can be read as they go.
+
+    Streamed command lines are droppable: once LOG_QUEUE_LINES records
+    are waiting they are counted instead of queued, and a single note
+    says how many were not shown. The command's capture keeps them.
+    """
+
+    PACE = {"info": 0.2, "error": 1}
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.dropped = 0
+        self.drop_lock = threading.Lock()
+        self.thread = None
+        # (text, stream) the writer thread is writing, for close()
+        self.current = None
+        self.json_file = None
+        self.paced = False
+        self.start = time.monotonic()
+
+    def open_json(self, path):
+        """Start writing JSON Lines records to path"""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.json_file = open(path, "a", encoding="utf-8")
+
+    def emit(self, level, message, text, stream, droppable=False):
+        """Queue one record; never blocks"""
+        if droppable:
+            with self.drop_lock:
+                if self.queue.qsize() >= LOG_QUEUE_LINES:
+                    self.dropped += 1
+                    return
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                self._note_dropped(dropped)
+        record = {
+            "t": round(time.monotonic() - self.start, 6),
+            "time": datetime.now().isoformat(timespec="milliseconds"),
+            "level": level,
+            "phase": _phase_name(),
+            "message": message,
+        }
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="log-writer", daemon=True
+            )
+            self.thread.start()
+        self.queue.put((record, text, stream))
+
+    def _note_dropped(self, count):
+        note = f"... {count} line(s) of command output not shown"
+        self.emit("output", note, note, "stdout")
+
+    def flush(self, timeout=None):
+        """
+        Wait until everything queued so far has been written, or at
+        most `timeout` seconds. Returns False if the wait timed out.
+        """
+        if self.thread is None:
+            return True
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Flush and close the JSON log. If the writer is still stuck after
+        `timeout` seconds, typically behind a prompt that holds the
+        terminal after Ctrl-C, the rest is written directly.
+        """
+        with self.drop_lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            self._note_dropped(dropped)
+        if not self.flush(timeout):
+            current = self.current
+            if current is not None:
+                self._write(None, *current, terminal=False)
+            while True:
+                try:
+                    record, text, stream = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                self._write(record, text, stream, terminal=False)
+                self.queue.task_done()
+        if self.json_file:
+            self.json_file.close()
+            self.json_file = None
+
+    def _run(self):
+        while True:
+            record, text, stream = self.queue.get()
+            self.current = (text, stream)
+            try:
+                self._write(record, text, stream)
+                self.current = None
+                if self.paced:
+                    time.sleep(self.PACE.get(record["level"], 0))
+            except Exception:
+                pass
+            finally:
+                self.current = None
+                self.queue.task_done()
+
+    def _write(self, record, text, stream, terminal=True):
+        if record is not None and self.json_file:
+            self.json_file.write(json.dumps(record) + "\n")
+            self.json_file.flush()
+        with _terminal_lock if terminal else contextlib.nullcontext():
+            out = sys.stderr if stream == "stderr" else sys.stdout
+            out.write(text + "\n")
+            out.flush()
+
+
+_log = LogWriter()
+
+
+def _phase_name():
+    """Name of the scheduled phase running on this thread, or None"""
+    return getattr(_phase_local, "name", None)
+
+
+def _phase_tag():
+    """Return '[phase] ' for output produced inside a scheduled phase"""
+    name = _phase_name()
+    return f"[{name}] " if name else ""
+
+
 def log_info(message):
     """Log informational message"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"++=++ [INFO] {timestamp} ++=++ {message}")
-    time.sleep(0.2)
+    text = f"++=++ [INFO] {timestamp} ++=++ {_phase_tag()}{message}"
+    _log.emit("info", message, text, "stdout")
 
 
 def log_error(message):
     """Log error message"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"++=++ [ERROR] {timestamp} ++=++ : {message}", file=sys.stderr)
-    time.sleep(1)
+    text = f"++=++ [ERROR] {timestamp} ++=++ : {_phase_tag()}{message}"
+    _log.emit("error", message, text, "stderr")
 
 
 def log_header(message):
     """Log section header"""
-    print(f"\n========== \t {message} \t ==========\n")
+    text = f"\n========== \t {_phase_tag()}{message} \t ==========\n"
+    _log.emit("header", message, text, "stdout")
 
 
 def log_subheading(message):
     """Log subsection heading"""
-    print(f"\n----- \t {message} \t -----\n")
+    text = f"\n----- \t {_phase_tag()}{message} \t -----\n"
+    _log.emit("subheading", message, text, "stdout")
+
+
+def log_output(text="", stream="stdout"):
+    """Log raw (command) output as-is"""
+    _log.emit("output", text, text, stream)
+
+
+def log_stream(text, stream="stdout"):
+    """Log a streamed command line, which the writer may leave out"""
+    _log.emit("output", text, text, stream, droppable=True)
+
+
+# ============================================================
+# PERFORMANCE INSTRUMENTATION
+# ============================================================
+
+
+def _net_rx_bytes():
+    """Bytes received on all non-loopback interfaces so far"""
+    try:
+        with open("/proc/net/dev", encoding="utf-8") as f:
+            lines = f.readlines()[2:]
+    except OSError:
+        return 0
+    total = 0
+    for line in lines:
+        iface, _, counters = line.partition(":")
+        if iface.strip() != "lo" and counters.split():
+            total += int(counters.split()[0])
+    return total
+
+
+def _disk_free(path="/"):
+    try:
+        stat = os.statvfs(path)
+        return stat.f_bavail * stat.f_frsize
+    except OSError:
+        return 0
+
+
+def _wait_child(proc, record):
+    """
+    Reap proc with wait4 and record that command's own CPU time and peak
+    RSS (its waited-for descendants included). The RSS high-water mark
+    survives exec, so no command reports less than this script had when
+    it forked. Returns the exit code.
+    """
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    record["child_cpu"] = round(usage.ru_utime + usage.ru_stime, 3)
+    # ru_maxrss is in KiB on Linux
+    record["peak_rss"] = usage.ru_maxrss * 1024
+    return proc.returncode
+
+
+class PerfRecorder:
+    """
+    Records wall time, bytes downloaded and disk usage change per phase
+    and per command, and writes one JSON report per run. Commands reaped
+    by _wait_child also record their own CPU time and peak RSS; a phase
+    sums its commands' CPU time and keeps their highest peak RSS.
+
+    Downloads and disk usage are system-wide counters sampled around
+    each phase and command, so work that overlaps sees each other's.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.phases = {}
+        self.commands = []
+        self.saved = None
+
+    @staticmethod
+    def _sample():
+        return {
+            "wall": time.monotonic(),
+            "rx": _net_rx_bytes(),
+            "disk_free": _disk_free(),
+        }
+
+    @staticmethod
+    def _deltas(start, end):
+        return {
+            "wall": round(end["wall"] - start["wall"], 3),
+            "downloaded": end["rx"] - start["rx"],
+            "disk_delta": start["disk_free"] - end["disk_free"],
+        }
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Measure a phase for the duration of the with block"""
+        start = self._sample()
+        try:
+            yield
+        finally:
+            record = self._deltas(start, self._sample())
+            with self.lock:
+                commands = [c for c in self.commands if c["phase"] == name]
+                record["child_cpu"] = round(
+                    sum(c.get("child_cpu", 0) for c in commands), 3
+                )
+                record["peak_rss"] = max(
+                    (c.get("peak_rss", 0) for c in commands), default=0
+                )
+                self.phases[name] = record
+
+    @contextlib.contextmanager
+    def command(self, cmd):
+        """Measure one external command; yields a dict for extra fields"""
+        record = {"cmd": " ".join(map(str, cmd))[:200], "phase": _phase_name()}
+        start = self._sample()
+        try:
+            yield record
+        finally:
+            record.update(self._deltas(start, self._sample()))
+            with self.lock:
+                self.commands.append(record)
+
+    def report(self):
+        with self.lock:
+            return {
+                "started": datetime.fromtimestamp(self.started).isoformat(),
+                "wall": round(time.time() - self.started, 3),
+                "phases": dict(self.phases),
+                "commands": list(self.commands),
+            }
+
+    def save(self):
+        """Write this run's report once; returns its path or None"""
+        if self.saved:
+            return self.saved
+        stamp = datetime.fromtimestamp(self.started).strftime("%Y%m%d-%H%M%S")
+        path = f"{PERF_DIR}/run-{stamp}.json"
+        try:
+            _write_atomic(path, json.dumps(self.report(), indent=1))
+        except OSError as e:
+            log_error(f"Could not save performance report: {e}")
+            return None
+        self.saved = path
+        return path
+
+    def previous_reports(self, limit=None):
+        """The most recent saved reports of earlier runs, newest first"""
+        try:
+            names = sorted(os.listdir(PERF_DIR), reverse=True)
+        except OSError:
+            return []
+        reports = []
+        for name in names:
+            path = os.path.join(PERF_DIR, name)
+            if not name.endswith(".json") or path == self.saved:
+                continue
+            report = _load_json(path)
+            if report:
+                reports.append(report)
+            if len(reports) >= (limit or PERF_HISTORY_RUNS):
+                break
+        return reports
+
+    def regressions(self):
+        """
+        Compare each phase's wall time with the median of previous
+        runs. Returns (name, wall, median, flagged) tuples.
+        """
+        import statistics
+
+        history = self.previous_reports()
+        rows = []
+        for name, current in sorted(self.report()["phases"].items()):
+            past = [
+                report["phases"][name]["wall"]
+                for report in history
+                if name in report.get("phases", {})
+            ]
+            if not past:
+                rows.append((name, current["wall"], None, False))
+                continue
+            median = statistics.median(past)
+            flagged = (
+                current["wall"] > median * PERF_REGRESSION_FACTOR
+                and current["wall"] - median > PERF_REGRESSION_MIN_SECONDS
+            )
+            rows.append((name, current["wall"], median, flagged))
+        return rows
+
+
+_perf = PerfRecorder()
 
 
 # ============================================================
@@ -56,18 +566,144 @@ def log_subheading(message):
 # ============================================================
 
 
-def ask_yes_no(prompt, default="N"):
-    """Ask yes/no question with default"""
-    while True:
-        answer = input(f"++=++ {prompt} ({default}): ").strip() or default
+# Every question the pipeline can ask: (key, prompt, default, parent).
+# A question is only relevant when its parent was answered yes. Keys
+# are also the names used in answer profiles; per-item questions may
+# be preset as "key" for all items or "key:item" for one.
+QUESTIONS = [
+    ("mirrors.rerank", "Rerank the mirrors?", "N", None),
+    (
+        "mirrors.revert_backups",
+        "Revert mirrorlists from .bak files",
+        "N",
+        "mirrors.rerank",
+    ),
+    (
+        "mirrors.remove_backups",
+        "Remove old mirrorlist backups?",
+        "N",
+        "mirrors.rerank",
+    ),
+    ("fwupd.update", "Update firmware with fwupdmgr", "N", None),
+    (
+        "fwupd.revert_backups",
+        "Revert firmware mirrorlists from .bak files",
+        "N",
+        "fwupd.update",
+    ),
+    ("pacman.check_lock", "Check database lock", "Y", None),
+    ("pacman.report_missing", "Check missing or broken database/packages", "Y", None),
+    ("pacman.fix_dependencies", "Try fixing missing dependencies", "Y", None),
+    ("yay.remove_orphans", "Remove orphaned packages?", "Y", None),
+    (
+        "manifest.install_missing",
+        "Install packages missing from the manifest?",
+        "N",
+        None,
+    ),
+    ("flatpak.remove_unused", "Remove unused flatpak packages?", "Y", None),
+    ("flatpak.repair", "Check flatpak checksums?", "N", None),
+    ("zinit.update", "Update Zinit", "N", None),
+    ("zinit.update_plugins", "Update zinit plugins", "Y", "zinit.update"),
+    ("logs.vacuum_journal", "Vacuum journalctl down?", "N", None),
+    ("logs.truncate_active", "Shorten ACTIVE log files? (Highly invasive)", "N", None),
+    ("logs.clear_coredumps", "Clear coredumps?", "N", None),
+    (
+        "logs.apply_cleanup",
+        "Apply the coredump/temp cleanup plan?",
+        "N",
+        "logs.clear_coredumps",
+    ),
+    ("final.reboot", "Reboot now?", "N", None),
+]
+
+
+def _parse_answer(answer):
+    """Map Y/YES/N/NO (or a JSON bool) to True/False, else None"""
+    if isinstance(answer, bool):
+        return answer
+    answer = str(answer).strip().upper()
+    if answer in ["Y", "YES"]:
+        return True
+    if answer in ["N", "NO"]:
+        return False
+    return None
 
-        if answer.upper() in ["Y", "YES"]:
-            return True
-        if answer.upper() in ["N", "NO"]:
-            return False
+
+def _prompt_yes_no(prompt, default):
+    """Prompt on the terminal until a yes/no answer is given"""
+    while True:
+        _log.flush()
+        with _terminal_lock:
+            answer = input(f"++=++ {_phase_tag()}{prompt} ({default}): ")
+        answer = _parse_answer(answer.strip() or default)
+        if answer is not None:
+            return answer
         log_error("Invalid input. Please enter Yes or No.")
 
 
+def ask_yes_no(prompt, default="N", key=None, item=None):
+    """
+    Ask yes/no question with default. A preset answer for `key` (or
+    "key:item") is used without prompting; in unattended mode any
+    other question takes its default.
+    """
+    if key is not None:
+        for preset in ([f"{key}:{item}"] if item else []) + [key]:
+            if preset in _answers:
+                answer = _answers[preset]
+                log_info(f"{prompt} -> {'yes' if answer else 'no'} (preset)")
+                return answer
+
+    if _unattended:
+        answer = _parse_answer(default)
+        log_info(f"{prompt} -> {'yes' if answer else 'no'} (default)")
+        return answer
+
+    return _prompt_yes_no(prompt, default)
+
+
+def _assume_yes(flag="--noconfirm"):
+    """Extra arguments that keep a package manager from prompting"""
+    return [flag] if _unattended else []
+
+
+def load_answers(path):
+    """Load an answer profile: a JSON object of question key -> yes/no"""
+    with open(path, encoding="utf-8") as f:
+        profile = json.load(f)
+
+    answers = {}
+    for key, value in profile.items():
+        answer = _parse_answer(value)
+        if answer is None:
+            raise ValueError(f"{path}: invalid answer for {key}: {value!r}")
+        answers[key] = answer
+    return answers
+
+
+def collect_answers():
+    """
+    Ask every relevant question up front so the run never blocks.
+    Questions already answered by the profile are not asked again.
+    """
+    log_header("Upgrade questionnaire")
+    for key, prompt, default, parent in QUESTIONS:
+        if key in _answers:
+            continue
+        if parent is not None and not _answers.get(parent):
+            continue
+        _answers[key] = _prompt_yes_no(prompt, default)
+
+
+def format_bytes(size):
+    """Format a byte count for humans, like du -h"""
+    for unit in ["B", "K", "M", "G", "T"]:
+        if abs(size) < 1024 or unit == "T":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{size}B"
+        size /= 1024
+
+
 def show_disk_space(label):
     """Get and display disk space info"""
     log_info(f"{label}:")
@@ -79,7 +715,9 @@ def show_disk_space(label):
         used = total - free
         percent = (used / total) * 100
 
-        print(f"  Used: {used:.1f}G / Available: {free:.1f}G ({percent:.1f}% used)")
+        log_output(
+            f"  Used: {used:.1f}G / Available: {free:.1f}G ({percent:.1f}% used)"
+        )
     except Exception as e:
         log_error(f"Could not get disk space: {e}")
 
@@ -89,27 +727,134 @@ def command_exists(command):
     return shutil.which(command) is not None
 
 
-def run_command(cmd, capture_output=False, check_error=True):
+class OutputCapture:
+    """
+    One stream of a command's output. The newest OUTPUT_TAIL_LINES lines
+    stay in a ring buffer; the full text goes to a temporary file that
+    only reaches the disk once it outgrows OUTPUT_SPOOL_BYTES.
+    """
+
+    def __init__(self):
+        import tempfile
+
+        self.tail = deque(maxlen=OUTPUT_TAIL_LINES)
+        self.spool = tempfile.SpooledTemporaryFile(
+            max_size=OUTPUT_SPOOL_BYTES, mode="w+", encoding="utf-8"
+        )
+
+    def append(self, line):
+        self.tail.append(line)
+        self.spool.write(line)
+
+    def text(self):
+        """The full captured text; closes the spool"""
+        with self.spool:
+            self.spool.seek(0)
+            return self.spool.read()
+
+
+def _pump_lines(pipe, capture, on_line, phase):
+    _phase_local.name = phase
+    for line in pipe:
+        capture.append(line)
+        on_line(line.rstrip("\n"))
+
+
+def _run_streamed(cmd, prefix, record):
+    """
+    Run cmd reading stdout and stderr concurrently, showing every line
+    as it arrives behind `prefix| `. Resource usage goes into the perf
+    record. Returns (proc, stdout, stderr, stderr_tail) where stderr_tail
+    holds the last OUTPUT_TAIL_LINES lines of stderr.
+    """
+    captures = {"stdout": OutputCapture(), "stderr": OutputCapture()}
+    with subprocess.Popen(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace",
+        bufsize=1,
+    ) as proc:
+        pumps = [
+            threading.Thread(
+                target=_pump_lines,
+                args=(
+                    getattr(proc, name),
+                    capture,
+                    lambda line, name=name: log_stream(f"{prefix}| {line}", name),
+                    _phase_name(),
+                ),
+                daemon=True,
+            )
+            for name, capture in captures.items()
+        ]
+        for pump in pumps:
+            pump.start()
+        for pump in pumps:
+            pump.join()
+        _wait_child(proc, record)
+    stderr = captures["stderr"]
+    return proc, captures["stdout"].text(), stderr.text(), list(stderr.tail)
+
+
+def run_command(cmd, capture_output=False, check_error=True, stream=None):
     """
     Run a command using Popen with proper resource cleanup.
+    With capture_output and a `stream` prefix, output is also shown
+    live, line by line, while it is captured. Otherwise the command
+    gets the terminal, except in unattended mode: nothing can prompt
+    then, so its output is streamed behind the phase name and other
+    phases keep running.
     Returns (returncode, stdout, stderr)
     """
+    if not capture_output and _unattended:
+        capture_output = True
+        stream = stream or _phase_name() or os.path.basename(cmd[0])
+
     try:
-        if capture_output:
-            with subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-            ) as proc:
-                stdout, stderr = proc.communicate()
+        with _perf.command(cmd) as record:
+            if capture_output and stream:
+                proc, stdout, stderr, stderr_tail = _run_streamed(
+                    cmd, stream, record
+                )
 
-        else:
-            # When not capturing output, inherit parent's stdout/stderr
-            with subprocess.Popen(cmd, stdout=None, stderr=None) as proc:
-                proc.wait()
-                stdout, stderr = "", ""
+            elif capture_output:
+                with subprocess.Popen(
+                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+                ) as proc:
+                    # Read both pipes, then reap with wait4 rather than
+                    # communicate(), which would reap the child itself
+                    errors = []
+                    reader = threading.Thread(
+                        target=lambda: errors.append(proc.stderr.read()), daemon=True
+                    )
+                    reader.start()
+                    stdout = proc.stdout.read()
+                    reader.join()
+                    stderr = errors[0]
+                    _wait_child(proc, record)
+
+            else:
+                # When not capturing output, inherit parent's stdout/stderr;
+                # the command owns the terminal until it exits
+                _log.flush()
+                with _terminal_lock:
+                    with subprocess.Popen(cmd, stdout=None, stderr=None) as proc:
+                        _wait_child(proc, record)
+                        stdout, stderr = "", ""
+            record["returncode"] = proc.returncode
 
         if check_error and proc.returncode != 0:
             log_error(f"Command failed: {' '.join(cmd)}")
-            if stderr:
+            if capture_output and stream:
+                # Streamed lines may be far back among other phases' output
+                if stderr_tail:
+                    log_error(
+                        f"Last lines of stderr:\n{''.join(stderr_tail).rstrip()}"
+                    )
+            elif stderr:
                 log_error(stderr)
 
         return proc.returncode, stdout, stderr
@@ -119,6 +864,31 @@ def run_command(cmd, capture_output=False, check_error=True):
         return 1, "", str(e)
 
 
+def stream_command(cmd, on_line):
+    """
+    Run a command and hand each line of its combined stdout/stderr to
+    on_line(line) as soon as it is printed. Nothing is buffered beyond
+    the current line. Returns the exit code.
+    """
+    try:
+        with _perf.command(cmd) as record:
+            with subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                bufsize=1,
+            ) as proc:
+                for line in proc.stdout:
+                    on_line(line.rstrip("\n"))
+                _wait_child(proc, record)
+            record["returncode"] = proc.returncode
+        return proc.returncode
+    except Exception as e:
+        log_error(f"Command execution failed: {e}")
+        return 1
+
+
 def backup_file(src, dst):
     """Move src -> dst safely"""
     try:
@@ -141,43 +911,2289 @@ def set_permissions(file_path, mode=0o644):
         return False
 
 
-def remove_file(file_path):
-    """Remove file if exists"""
-    try:
-        os.remove(file_path)
-        log_info(f"Removed {file_path}")
-        return True
-    except Exception as e:
-        log_error(f"Failed to remove {file_path}: {e}")
-        return False
+def remove_file(file_path):
+    """Remove file if exists"""
+    try:
+        os.remove(file_path)
+        log_info(f"Removed {file_path}")
+        return True
+    except Exception as e:
+        log_error(f"Failed to remove {file_path}: {e}")
+        return False
+
+
+def revert_mirrorlist_backups(mirror_dir):
+    """Revert mirrorlist backup files using shutil/os"""
+    mirror_path = Path(mirror_dir)
+
+    if not mirror_path.exists():
+        log_error(f"Directory {mirror_dir} does not exist")
+        return False
+
+    reverted_count = 0
+    for bak_file in mirror_path.glob("*.bak"):
+        original = bak_file.with_suffix("")
+        if backup_file(str(bak_file), str(original)):
+            if set_permissions(str(original)):
+                log_info(f"Reverted: {bak_file}")
+                reverted_count += 1
+            else:
+                log_error(f"Failed to set permissions for {original}")
+        else:
+            log_error(f"Failed to revert {bak_file}")
+
+    if reverted_count == 0:
+        log_info(f"No .bak files found to revert in {mirror_dir}")
+    else:
+        log_info(f"Reverted {reverted_count} .bak file(s).")
+
+    return True
+
+
+# ============================================================
+# PHASE SCHEDULER
+# ============================================================
+
+
+class Phase:
+    """
+    An upgrade phase with its ordering and resource needs.
+
+    deps are phase names that must have finished first (phases that are
+    not scheduled are ignored). exclusive resources are held by one
+    phase at a time, shared ones only conflict with an exclusive holder.
+    pending, if given, is called once the resources are held and the
+    phase is skipped when it returns False. inputs are the paths whose
+    fingerprints decide whether a resumed run may skip the phase;
+    resumed is called when it does.
+    """
+
+    def __init__(
+        self,
+        name,
+        func,
+        deps=(),
+        exclusive=(),
+        shared=(),
+        enabled=True,
+        pending=None,
+        inputs=(),
+        resumed=None,
+    ):
+        self.name = name
+        self.func = func
+        self.deps = tuple(deps)
+        self.exclusive = tuple(exclusive)
+        self.shared = tuple(shared)
+        self.enabled = enabled
+        self.pending = pending
+        self.inputs = tuple(inputs)
+        self.resumed = resumed
+
+
+def _resources_free(phase, exclusive_held, shared_held):
+    """Check whether a phase's resources can be acquired right now"""
+    for resource in phase.exclusive:
+        if resource in exclusive_held or shared_held.get(resource):
+            return False
+    return not any(resource in exclusive_held for resource in phase.shared)
+
+
+def _run_phase(phase, finished):
+    """Run one phase on a worker thread and report back on `finished`"""
+    _phase_local.name = phase.name
+    try:
+        with _perf.phase(phase.name):
+            if _journal.completed(phase):
+                log_info(f"Skipping {phase.name}: completed by the resumed run")
+                if phase.resumed:
+                    phase.resumed()
+                finished.put((phase.name, _journal.result(phase.name), None))
+                return
+            if _skip_up_to_date and phase.pending and not phase.pending():
+                log_info(f"Skipping {phase.name}: nothing to update")
+                result = None
+            else:
+                result = phase.func()
+        _journal.record(phase, result)
+        finished.put((phase.name, result, None))
+    except BaseException as e:  # reported to and handled by the scheduler
+        if not isinstance(e, KeyboardInterrupt):
+            _journal.record(phase, error=e)
+        finished.put((phase.name, None, e))
+    finally:
+        _phase_local.name = None
+
+
+def run_phases(phases, max_workers=None):
+    """
+    Run phases as soon as their dependencies are done and their
+    resources are free, up to max_workers at a time.
+
+    A phase that raises is logged and its dependents are skipped.
+    Returns {name: result} for every phase that ran.
+    """
+    max_workers = max_workers or PHASE_WORKERS
+    pending = {phase.name: phase for phase in phases if phase.enabled}
+    results = {}
+    failed = set()
+    running = {}
+    exclusive_held = set()
+    shared_held = {}
+    finished = queue.Queue()
+
+    while pending or running:
+        for name, phase in list(pending.items()):
+            if len(running) >= max_workers:
+                break
+            deps = [dep for dep in phase.deps if dep in pending or dep in running]
+            if deps:
+                continue
+            if any(dep in failed for dep in phase.deps):
+                log_error(f"Skipping {name}: a phase it depends on failed")
+                failed.add(name)
+                del pending[name]
+                continue
+            if not _resources_free(phase, exclusive_held, shared_held):
+                continue
+
+            del pending[name]
+            running[name] = phase
+            exclusive_held.update(phase.exclusive)
+            for resource in phase.shared:
+                shared_held[resource] = shared_held.get(resource, 0) + 1
+            threading.Thread(
+                target=_run_phase, args=(phase, finished), name=name, daemon=True
+            ).start()
+
+        if not running:
+            if pending:
+                # Unsatisfiable dependencies; should not happen
+                log_error(f"Cannot schedule phases: {', '.join(pending)}")
+            break
+
+        name, result, error = finished.get()
+        phase = running.pop(name)
+        exclusive_held.difference_update(phase.exclusive)
+        for resource in phase.shared:
+            shared_held[resource] -= 1
+
+        if error is not None:
+            if isinstance(error, KeyboardInterrupt):
+                raise error
+            log_error(f"Phase {name} failed: {error}")
+            import traceback
+
+            log_output("".join(traceback.format_exception(error)).rstrip(), "stderr")
+            failed.add(name)
+        else:
+            results[name] = result
+
+    return results
+
+
+# ============================================================
+# RUN JOURNAL
+# ============================================================
+
+
+def _fingerprint(path):
+    """
+    Cheap identity of a phase input: the content hash of a small file,
+    mtime and size of a large one, the mtime of a directory (it changes
+    when entries are added, removed or replaced), None if missing.
+    """
+    import hashlib
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if os.path.isdir(path):
+        return f"dir:{st.st_mtime_ns}"
+    if st.st_size <= 1024 * 1024:
+        with open(path, "rb") as f:
+            return f"sha256:{hashlib.sha256(f.read()).hexdigest()}"
+    return f"file:{st.st_mtime_ns}:{st.st_size}"
+
+
+class RunJournal:
+    """
+    Checkpoints of the current run in RUN_JOURNAL: every finished phase
+    with its status, result and the fingerprints of its inputs taken
+    when it finished.
+
+    A run started with resume=True loads the journal of the previous
+    run if that run did not complete and is younger than
+    RESUME_MAX_AGE. Phases it completed are then skipped as long as
+    their inputs still match, so a retry only redoes what failed or
+    what changed underneath it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = None
+        self.previous = {}
+
+    def start(self, resume=False):
+        previous = _load_json(RUN_JOURNAL, {}) if resume else {}
+        if resume:
+            if not previous:
+                log_info("No earlier run to resume, starting from scratch")
+            elif previous.get("complete"):
+                log_info("The last run completed, starting from scratch")
+                previous = {}
+            elif time.time() - previous.get("started", 0) > RESUME_MAX_AGE:
+                log_info("The interrupted run is too old to resume")
+                previous = {}
+
+        self.previous = {
+            name: record
+            for name, record in previous.get("phases", {}).items()
+            if record.get("status") == "done"
+        }
+        if self.previous:
+            log_info(f"Resuming: {', '.join(self.previous)} already completed")
+        with self.lock:
+            self.state = {
+                "started": time.time(),
+                "resumed_from": previous.get("started"),
+                "complete": False,
+                "phases": dict(self.previous),
+            }
+            self._save()
+
+    def _save(self):
+        try:
+            _write_atomic(RUN_JOURNAL, json.dumps(self.state, indent=2) + "\n")
+        except OSError as e:
+            log_error(f"Could not save run journal: {e}")
+
+    @staticmethod
+    def _inputs(phase):
+        return {path: _fingerprint(path) for path in phase.inputs}
+
+    def completed(self, phase):
+        """Whether the resumed run completed phase on today's inputs"""
+        record = self.previous.get(phase.name)
+        return record is not None and record.get("inputs") == self._inputs(phase)
+
+    def result(self, name):
+        return self.previous[name].get("result")
+
+    def record(self, phase, result=None, error=None):
+        """Checkpoint a finished phase; a non-zero result counts as failed"""
+        if self.state is None:
+            return
+        if not isinstance(result, (int, str, type(None))):
+            result = repr(result)
+        failed = error is not None or result not in (None, 0)
+        entry = {
+            "status": "failed" if failed else "done",
+            "finished": time.time(),
+            "result": result,
+            "error": None if error is None else str(error),
+            "inputs": self._inputs(phase),
+        }
+        with self.lock:
+            self.state["phases"][phase.name] = entry
+            self._save()
+
+    def finish(self, names):
+        """Mark the run complete if every named phase is done"""
+        if self.state is None:
+            return
+        with self.lock:
+            phases = self.state["phases"]
+            self.state["complete"] = all(
+                phases.get(name, {}).get("status") == "done" for name in names
+            )
+            self._save()
+
+
+_journal = RunJournal()
+
+
+# ============================================================
+# ASYNC TASK RUNNER
+# ============================================================
+
+
+def _kill_group(proc, sig):
+    """Send sig to the process group led by proc, if it still exists"""
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class TaskRunner:
+    """
+    Runs external commands (and blocking callables) concurrently on an
+    asyncio event loop instead of a pool of forked Python workers.
+
+    Every command gets a process group of its own, so a timeout or a
+    cancellation terminates the command together with everything it
+    spawned. At most `concurrency` tasks run at once; on_result(result)
+    is called as each task finishes and on_line(name, stream, line) for
+    every line a command prints.
+
+    run() blocks the calling thread and returns one result dict per task
+    in the order they were added, with "name", "returncode", "stdout",
+    "stderr", "log", "elapsed" and "status" ("ok", "failed", "timeout"
+    or "cancelled"). Callables return such a dict themselves. They
+    cannot be killed, so they get a `cancel` keyword argument, a
+    threading.Event that is set once they time out or are cancelled and
+    abandoned; they should stop before doing anything else when it is.
+    """
+
+    _active = set()
+    _active_lock = threading.Lock()
+
+    def __init__(self, concurrency=4, timeout=None, on_result=None, on_line=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.on_result = on_result
+        self.on_line = on_line
+        self.tasks = []
+        self.loop = None
+        self.main_task = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def add_command(self, name, cmd, timeout=None):
+        self.tasks.append((name, list(cmd), None, timeout or self.timeout))
+
+    def add_call(self, name, func, *args, timeout=None):
+        self.tasks.append((name, func, args, timeout or self.timeout))
+
+    def run(self):
+        import asyncio
+
+        with TaskRunner._active_lock:
+            TaskRunner._active.add(self)
+        try:
+            return asyncio.run(self._run_all())
+        finally:
+            with TaskRunner._active_lock:
+                TaskRunner._active.discard(self)
+            self.done.set()
+
+    def cancel(self):
+        """Cancel all tasks from any thread; run() then returns"""
+        self.cancelled = True
+        loop, task = self.loop, self.main_task
+        if loop is not None and task is not None:
+            try:
+                loop.call_soon_threadsafe(task.cancel)
+            except RuntimeError:  # loop already closed
+                pass
+
+    @classmethod
+    def cancel_all(cls, wait=5):
+        """
+        Cancel every runner in progress and wait up to `wait` seconds
+        for their commands to be killed.
+        """
+        with cls._active_lock:
+            runners = list(cls._active)
+        for runner in runners:
+            runner.cancel()
+        deadline = time.monotonic() + wait
+        for runner in runners:
+            runner.done.wait(max(0, deadline - time.monotonic()))
+
+    async def _run_all(self):
+        import asyncio
+
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        if self.cancelled:
+            raise KeyboardInterrupt
+        limit = asyncio.Semaphore(max(1, self.concurrency))
+        phase = _phase_name()
+
+        async def run_one(name, target, args, timeout):
+            async with limit:
+                start = time.monotonic()
+                if args is None:
+                    result = await self._run_command(name, target, timeout)
+                else:
+                    result = await self._run_call(name, target, args, timeout, phase)
+                result["elapsed"] = time.monotonic() - start
+                result.setdefault(
+                    "status", "ok" if result["returncode"] == 0 else "failed"
+                )
+                if self.on_result:
+                    self.on_result(result)
+                return result
+
+        jobs = [asyncio.create_task(run_one(*task)) for task in self.tasks]
+        try:
+            return await asyncio.gather(*jobs)
+        except asyncio.CancelledError:
+            for job in jobs:
+                job.cancel()
+            await asyncio.gather(*jobs, return_exceptions=True)
+            raise KeyboardInterrupt from None
+
+    async def _read_lines(self, name, stream_name, stream, capture):
+        while line := await stream.readline():
+            text = line.decode(errors="replace")
+            capture.append(text)
+            if self.on_line:
+                self.on_line(name, stream_name, text.rstrip("\n"))
+
+    async def _run_command(self, name, cmd, timeout):
+        import asyncio
+
+        result = {"name": name, "cmd": cmd, "log": f"[{name}] {' '.join(cmd)}"}
+        with _perf.command(cmd) as record:
+            try:
+                proc = await asyncio.create_subprocess_exec(
+                    *cmd,
+                    stdin=asyncio.subprocess.DEVNULL,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE,
+                    start_new_session=True,
+                )
+            except OSError as e:
+                record["returncode"] = 127
+                return dict(result, returncode=127, stdout="", stderr=str(e))
+
+            out, err = OutputCapture(), OutputCapture()
+            readers = asyncio.gather(
+                self._read_lines(name, "stdout", proc.stdout, out),
+                self._read_lines(name, "stderr", proc.stderr, err),
+                proc.wait(),
+            )
+            try:
+                await asyncio.wait_for(readers, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                await self._stop(proc)
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                result["status"] = "timeout"
+                err.append(f"\n{name}: timed out after {timeout}s\n")
+            finally:
+                record["returncode"] = proc.returncode
+
+        return dict(
+            result,
+            returncode=proc.returncode,
+            stdout=out.text(),
+            stderr=err.text(),
+        )
+
+    @staticmethod
+    async def _stop(proc, grace=3):
+        """Terminate the command's process group, then kill it"""
+        import asyncio
+
+        _kill_group(proc, signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.shield(proc.wait()), grace)
+        except asyncio.TimeoutError:
+            _kill_group(proc, signal.SIGKILL)
+            await proc.wait()
+
+    async def _run_call(self, name, func, args, timeout, phase):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def finish(result, error):
+            if not future.done():
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
+
+        cancel = threading.Event()
+
+        def target():
+            _phase_local.name = phase
+            result = error = None
+            try:
+                result = func(*args, cancel=cancel)
+            except Exception as e:
+                error = e
+            try:
+                loop.call_soon_threadsafe(finish, result, error)
+            except RuntimeError:  # abandoned after a timeout or cancel
+                pass
+
+        threading.Thread(target=target, name=name, daemon=True).start()
+        failure = {"name": name, "returncode": 1, "stdout": "", "log": ""}
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return dict(
+                failure,
+                status="timeout",
+                stderr=f"{name}: timed out after {timeout}s",
+            )
+        except Exception as e:
+            return dict(failure, stderr=str(e))
+        finally:
+            # Tells an abandoned callable to stop; a finished one ignores it
+            cancel.set()
+
+
+# ============================================================
+# MIRRORLIST DOWNLOAD CACHE
+# ============================================================
+
+
+def parse_mirrorlist(data):
+    """Extract every server line, commented out or not"""
+    servers = []
+    for line in data.splitlines():
+        if line.startswith("#Server"):
+            servers.append(line[1:].strip())
+        elif line.startswith("Server"):
+            servers.append(line.strip())
+    return servers
+
+
+def _load_json(path, default=None):
+    """Read a JSON state file, returning default if missing or corrupt"""
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _write_atomic(path, data, mode=0o644):
+    """Write text or bytes to path via a temporary file and rename"""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    if isinstance(data, bytes):
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+    else:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+    os.chmod(tmp_path, mode)
+    os.replace(tmp_path, path)
+
+
+def fetch_arch_mirrorlist(url=None, cache_path=None, timeout=20):
+    """
+    Fetch the Arch mirrorlist with a conditional request.
+
+    The raw list is cached together with its ETag, Last-Modified, hash
+    and parsed server set. A 304, an HTTP error, a timeout or no network
+    at all reuse the cached copy; an unchanged body skips parsing.
+    Returns (servers, source) where source is "downloaded", "unchanged",
+    "not-modified" or "offline".
+    """
+    import hashlib
+    import urllib.error
+    import urllib.request
+
+    url = url or ARCH_MIRRORLIST_URL
+    cache_path = cache_path or MIRRORLIST_CACHE
+    meta_path = f"{cache_path}.json"
+    meta = _load_json(meta_path, {}) if os.path.isfile(cache_path) else {}
+
+    headers = {"User-Agent": "ArchMirrorRanker"}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+
+    def cached_servers():
+        if meta.get("servers") is not None:
+            return meta["servers"]
+        with open(cache_path, encoding="utf-8") as f:
+            return parse_mirrorlist(f.read())
+
+    try:
+        req = urllib.request.Request(url, headers=headers)
+        with urllib.request.urlopen(req, timeout=timeout) as resp:
+            raw = resp.read()
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+    except urllib.error.HTTPError as e:
+        if not meta:
+            raise
+        if e.code == 304:
+            return cached_servers(), "not-modified"
+        return cached_servers(), "offline"
+    except (urllib.error.URLError, TimeoutError, OSError):
+        if meta:
+            return cached_servers(), "offline"
+        raise
+
+    digest = hashlib.sha256(raw).hexdigest()
+    if meta.get("sha256") == digest and meta.get("servers") is not None:
+        servers, source = meta["servers"], "unchanged"
+    else:
+        servers, source = parse_mirrorlist(raw.decode("utf-8")), "downloaded"
+
+    # Best effort: `mirrors --rank-only` runs without root
+    try:
+        if source == "downloaded":
+            _write_atomic(cache_path, raw)
+        _write_atomic(
+            meta_path,
+            json.dumps(
+                {
+                    "url": url,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "sha256": digest,
+                    "servers": servers,
+                }
+            ),
+        )
+    except OSError:
+        pass
+    return servers, source
+
+
+# ============================================================
+# NATIVE MIRROR RANKER
+# ============================================================
+
+
+def _server_url(server):
+    """Return the URL part of a 'Server = ...' line"""
+    return server.split("=", 1)[1].strip()
+
+
+def _mirror_probe_url(server, repo=None):
+    """Expand a mirrorlist server into the URL of a repo database"""
+    repo = repo or MIRROR_PROBE_REPO
+    url = _server_url(server)
+    url = url.replace("$repo", repo).replace("$arch", MIRROR_PROBE_ARCH)
+    return f"{url.rstrip('/')}/{repo}.db"
+
+
+def _score_bound(seconds):
+    """
+    Convert probe seconds into the lowest score a mirror could have,
+    used for probes that were abandoned or failed.
+    """
+    if MIRROR_PROBE_MODE == "throughput":
+        sampled = MIRROR_THROUGHPUT_BYTES * max(1, MIRROR_THROUGHPUT_SAMPLES)
+        return seconds * MIRROR_SCORE_PAYLOAD / sampled
+    return seconds
+
+
+def _probe_mirror(server, cutoff):
+    """
+    Time a full download of the probe database from one mirror.
+    cutoff() returns the current per-probe deadline in seconds. It is
+    the socket timeout and is checked between reads, so the probe is
+    abandoned at the first read past it.
+    Returns (status, score, stats) where status is "ok", "slow"
+    (abandoned at the deadline) or "error", and stats holds the probe's
+    "elapsed" seconds plus whatever it measured.
+    """
+    import urllib.request
+
+    url = _mirror_probe_url(server)
+    req = urllib.request.Request(url, headers={"User-Agent": "ArchMirrorRanker"})
+    start = time.monotonic()
+
+    try:
+        with urllib.request.urlopen(req, timeout=cutoff()) as resp:
+            while True:
+                if time.monotonic() - start > cutoff():
+                    raise TimeoutError("probe deadline exceeded")
+                if not resp.read(64 * 1024):
+                    break
+    except TimeoutError:
+        elapsed = time.monotonic() - start
+        return "slow", elapsed, {"elapsed": elapsed}
+    except Exception:
+        elapsed = time.monotonic() - start
+        return "error", elapsed, {"elapsed": elapsed}
+
+    elapsed = time.monotonic() - start
+    status = "ok" if elapsed <= cutoff() else "slow"
+    return status, elapsed, {"elapsed": elapsed, "latency": elapsed}
+
+
+class ConnectionPool:
+    """Thread-safe pool of idle keep-alive HTTP(S) connections per host"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, scheme, host, timeout):
+        """Return an open connection to scheme://host"""
+        import http.client
+
+        with self.lock:
+            conns = self.idle.get((scheme, host))
+            conn = conns.pop() if conns else None
+
+        if conn is not None:
+            conn.sock.settimeout(timeout)
+            return conn
+
+        conn_class = (
+            http.client.HTTPSConnection
+            if scheme == "https"
+            else http.client.HTTPConnection
+        )
+        conn = conn_class(host, timeout=timeout)
+        conn.connect()
+        return conn
+
+    def put(self, scheme, host, conn):
+        """Return a connection for reuse, dropping it if it was closed"""
+        if conn.sock is None:
+            return
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+def _ranged_get(conn, path, length, start, cutoff):
+    """
+    Fetch the first `length` bytes of path on an open connection.
+    Returns (first_byte_time, bytes_read). The connection is closed if
+    the server ignored the Range header and left body unread. Raises
+    TimeoutError once the deadline from cutoff() is exceeded.
+    """
+    import http.client
+
+    conn.request(
+        "GET",
+        path,
+        headers={
+            "User-Agent": "ArchMirrorRanker",
+            "Range": f"bytes=0-{length - 1}",
+        },
+    )
+    resp = conn.getresponse()
+    first_byte = time.monotonic()
+    if resp.status not in (200, 206):
+        conn.close()
+        raise http.client.HTTPException(f"HTTP {resp.status}")
+
+    received = 0
+    while received < length:
+        if time.monotonic() - start > cutoff():
+            conn.close()
+            raise TimeoutError("probe deadline exceeded")
+        chunk = resp.read(min(64 * 1024, length - received))
+        if not chunk:
+            break
+        received += len(chunk)
+
+    if not resp.isclosed() or resp.will_close:
+        conn.close()
+    return first_byte, received
+
+
+def _probe_mirror_throughput(server, cutoff, pool):
+    """
+    Measure sustained throughput with ranged fetches of a repo database.
+
+    Connection setup (including TLS) happens before the clock starts
+    and the pooled connection is reused for every sample. Latency is
+    the best time to first byte, throughput the best bytes per second
+    after it, and the score the estimated seconds to fetch
+    MIRROR_SCORE_PAYLOAD from this mirror.
+    Returns (status, score, stats) like _probe_mirror.
+    """
+    import urllib.parse
+
+    url = urllib.parse.urlsplit(_mirror_probe_url(server, MIRROR_THROUGHPUT_REPO))
+    latency = throughput = None
+
+    try:
+        conn = pool.get(url.scheme, url.netloc, cutoff())
+    except Exception:
+        return "error", _score_bound(cutoff()), {}
+
+    start = time.monotonic()
+    try:
+        for _ in range(max(1, MIRROR_THROUGHPUT_SAMPLES)):
+            if conn.sock is None:
+                conn.connect()
+            sent = time.monotonic()
+            first_byte, received = _ranged_get(
+                conn, url.path, MIRROR_THROUGHPUT_BYTES, start, cutoff
+            )
+            rate = received / max(time.monotonic() - first_byte, 1e-6)
+            latency = min(latency or first_byte - sent, first_byte - sent)
+            throughput = max(throughput or 0, rate)
+        pool.put(url.scheme, url.netloc, conn)
+    except TimeoutError:
+        elapsed = time.monotonic() - start
+        return "slow", _score_bound(elapsed), {"elapsed": elapsed}
+    except Exception:
+        conn.close()
+        elapsed = time.monotonic() - start
+        return "error", _score_bound(elapsed), {"elapsed": elapsed}
+
+    elapsed = time.monotonic() - start
+    score = latency + MIRROR_SCORE_PAYLOAD / max(throughput, 1)
+    stats = {"elapsed": elapsed, "latency": latency, "throughput": throughput}
+    return ("ok" if elapsed <= cutoff() else "slow"), score, stats
+
+
+def _probe_sweep(
+    servers, keep, timeout, probe, concurrency, on_result=None, cancel=None
+):
+    """
+    Run probe(server, cutoff) over servers, `concurrency` at a time, and
+    return the best `keep` successful ones as (server, score) pairs,
+    best first. on_result(server, status, score, stats) is called for
+    every finished probe.
+
+    Every probe starts with a deadline of `timeout` seconds. Once `keep`
+    probes have completed, the slowest of the fastest `keep` probes
+    becomes the deadline for all remaining ones: a mirror that cannot
+    finish the same probe as quickly cannot enter the result, so its
+    transfer is abandoned. Every server is still probed, since a queued
+    one may beat the current winners; the shrinking deadline only caps
+    how long each probe may take. The probe checks it between reads:
+    DNS lookups and connection setup count against it but are not cut
+    short by it. Connecting is bounded by the socket timeout, a DNS
+    lookup only by the resolver's own.
+
+    Once the `cancel` event is set, queued probes are dropped, running
+    ones are abandoned and no further results are reported.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    ranked = []
+    durations = []
+    lock = threading.Lock()
+    cancel = cancel or threading.Event()
+
+    def cutoff():
+        if cancel.is_set():
+            return 0
+        with lock:
+            if len(durations) >= keep:
+                return min(timeout, durations[keep - 1])
+            return timeout
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        pending = {pool.submit(probe, server, cutoff): server for server in servers}
+        while pending:
+            done, _ = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+            if cancel.is_set():
+                for future in pending:
+                    future.cancel()
+                break
+            for future in done:
+                server = pending.pop(future)
+                status, score, stats = future.result()
+                if on_result:
+                    on_result(server, status, score, stats)
+                if status != "ok":
+                    continue
+                with lock:
+                    ranked.append((server, score))
+                    ranked.sort(key=lambda item: item[1])
+                    del ranked[keep:]
+                    durations.append(stats["elapsed"])
+                    durations.sort()
+                    del durations[keep:]
+
+    return ranked
+
+
+def rank_mirrors_native(
+    servers,
+    num_mirrors,
+    timeout,
+    concurrency=None,
+    on_result=None,
+    cancel=None,
+    known=None,
+):
+    """
+    Probe mirrors and return the best servers as (server, score) pairs,
+    best first. Scores are in seconds: the probe time in "latency" mode,
+    the estimated time to fetch MIRROR_SCORE_PAYLOAD in "throughput"
+    mode. on_result(server, status, score, stats) is called for every
+    finished probe that is scored.
+
+    All mirrors are swept concurrently by latency. In "throughput" mode
+    only the best of them (num_mirrors + MIRROR_SHORTLIST_EXTRA) then get
+    ranged fetches, MIRROR_THROUGHPUT_CONCURRENCY at a time so that each
+    sample measures the mirror rather than its share of the local link.
+    Shortlisted servers found in `known`, {server: (latency,
+    throughput)}, are scored from those figures instead of being
+    fetched from again. If no throughput score is available, the
+    latency ranking is returned instead.
+    Setting the `cancel` event stops the ranking early; see _probe_sweep.
+    """
+    concurrency = concurrency or MIRROR_CONCURRENCY
+    if MIRROR_PROBE_MODE != "throughput":
+        return _probe_sweep(
+            servers,
+            num_mirrors,
+            timeout,
+            _probe_mirror,
+            concurrency,
+            on_result,
+            cancel,
+        )
+
+    def on_latency(server, status, score, stats):
+        # Only failures are final here; a latency time is no throughput score
+        if on_result and status != "ok":
+            on_result(server, status, _score_bound(stats["elapsed"]), stats)
+
+    shortlist = _probe_sweep(
+        servers,
+        num_mirrors + MIRROR_SHORTLIST_EXTRA,
+        timeout,
+        _probe_mirror,
+        concurrency,
+        on_latency,
+        cancel,
+    )
+    if cancel is not None and cancel.is_set():
+        return []
+
+    known = known or {}
+    reused = []
+    for server, _ in shortlist:
+        if server in known:
+            latency, throughput = known[server]
+            score = latency + MIRROR_SCORE_PAYLOAD / max(throughput, 1)
+            reused.append((server, score))
+            if on_result:
+                on_result(server, "ok", score, {})
+
+    sampled = MIRROR_THROUGHPUT_BYTES * max(1, MIRROR_THROUGHPUT_SAMPLES)
+    deadline = timeout + sampled / MIRROR_THROUGHPUT_MIN_RATE
+    connections = ConnectionPool()
+    try:
+        ranked = _probe_sweep(
+            [server for server, _ in shortlist if server not in known],
+            num_mirrors,
+            deadline,
+            lambda server, cutoff: _probe_mirror_throughput(
+                server, cutoff, connections
+            ),
+            MIRROR_THROUGHPUT_CONCURRENCY,
+            on_result,
+            cancel,
+        )
+    finally:
+        connections.close()
+
+    ranked = sorted(ranked + reused, key=lambda item: item[1])[:num_mirrors]
+    return ranked or shortlist[:num_mirrors]
+
+
+class MirrorHistory:
+    """
+    Per-mirror performance history kept in SQLite across runs.
+
+    Each mirror has an exponentially decayed score (lower is better, in
+    seconds). Successful probes feed their score in, a probe abandoned at
+    the deadline feeds in the best score it could still have had, and
+    errors feed in the score of a probe twice the timeout long, so
+    flapping mirrors sink quickly.
+    """
+
+    def __init__(self, path=None):
+        import sqlite3
+
+        path = path or MIRROR_HISTORY_DB
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mirrors (
+                url TEXT PRIMARY KEY,
+                score REAL,
+                latency REAL,
+                throughput REAL,
+                probes INTEGER NOT NULL DEFAULT 0,
+                failures INTEGER NOT NULL DEFAULT 0,
+                consecutive_failures INTEGER NOT NULL DEFAULT 0,
+                last_probe REAL,
+                last_success REAL,
+                throughput_at REAL
+            )
+            """
+        )
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(mirrors)")}
+        if "throughput_at" not in columns:
+            self.conn.execute("ALTER TABLE mirrors ADD COLUMN throughput_at REAL")
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def scores(self, urls):
+        """Return {url: row} for the given mirror URLs that have history"""
+        rows = self.conn.execute(
+            "SELECT url, score, last_probe, consecutive_failures FROM mirrors"
+        ).fetchall()
+        wanted = set(urls)
+        return {row[0]: row[1:] for row in rows if row[0] in wanted}
+
+    def throughputs(self, servers, now=None):
+        """
+        {server: (latency, throughput)} for the servers whose throughput
+        was measured within MIRROR_THROUGHPUT_MAX_AGE and that have not
+        failed since.
+        """
+        now = now or time.time()
+        by_url = {_server_url(server): server for server in servers}
+        rows = self.conn.execute(
+            """
+            SELECT url, latency, throughput FROM mirrors
+            WHERE throughput_at >= ? AND consecutive_failures = 0
+                AND latency IS NOT NULL AND throughput IS NOT NULL
+            """,
+            (now - MIRROR_THROUGHPUT_MAX_AGE,),
+        ).fetchall()
+        return {
+            by_url[url]: (latency, throughput)
+            for url, latency, throughput in rows
+            if url in by_url
+        }
+
+    def candidates(self, servers, num_mirrors, now=None):
+        """
+        Pick the servers worth probing this run, or all of them when the
+        history is too thin or too old for an incremental ranking.
+        """
+        import random
+
+        now = now or time.time()
+        by_url = {_server_url(server): server for server in servers}
+        known = self.scores(by_url)
+
+        fresh = [
+            url
+            for url, (score, last_probe, _) in known.items()
+            if score is not None and now - last_probe < MIRROR_FULL_SWEEP_AFTER
+        ]
+        if len(fresh) < num_mirrors:
+            return list(servers), True
+
+        ranked = sorted(fresh, key=lambda url: known[url][0])
+        chosen = set(ranked[: num_mirrors * 2])
+        chosen.update(
+            url
+            for url, (_, last_probe, _) in known.items()
+            if now - last_probe >= MIRROR_STALE_AFTER
+        )
+        rest = [url for url in by_url if url not in chosen]
+        chosen.update(random.sample(rest, min(MIRROR_EXPLORE, len(rest))))
+
+        return [by_url[url] for url in by_url if url in chosen], False
+
+    def record(self, server, status, sample, timeout, stats=None, now=None):
+        """Fold one probe result into the mirror's decayed score"""
+        now = now or time.time()
+        stats = stats or {}
+        url = _server_url(server)
+        ok = status == "ok"
+        if status == "error":
+            sample = _score_bound(timeout * 2)
+
+        row = self.conn.execute(
+            "SELECT score FROM mirrors WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None or row[0] is None:
+            score = sample
+        else:
+            score = MIRROR_HISTORY_DECAY * sample + (1 - MIRROR_HISTORY_DECAY) * row[0]
+
+        self.conn.execute(
+            """
+            INSERT INTO mirrors (url, score, latency, throughput, probes,
+                                 failures, consecutive_failures, last_probe,
+                                 last_success, throughput_at)
+            VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET
+                score = excluded.score,
+                latency = COALESCE(excluded.latency, latency),
+                throughput = COALESCE(excluded.throughput, throughput),
+                probes = probes + 1,
+                failures = failures + excluded.failures,
+                consecutive_failures = CASE WHEN excluded.failures = 0
+                    THEN 0 ELSE consecutive_failures + 1 END,
+                last_probe = excluded.last_probe,
+                last_success = COALESCE(excluded.last_success, last_success),
+                throughput_at = COALESCE(excluded.throughput_at, throughput_at)
+            """,
+            (
+                url,
+                score,
+                stats.get("latency"),
+                stats.get("throughput"),
+                0 if ok else 1,
+                0 if ok else 1,
+                now,
+                now if ok else None,
+                now if stats.get("throughput") else None,
+            ),
+        )
+        return score
+
+
+def rank_mirrors_incremental(servers, num_mirrors, timeout, log, name, cancel=None):
+    """
+    Rank mirrors using the on-disk history: only the current top
+    candidates, stale entries and an exploration sample are probed, and
+    throughput is only measured again where the recorded one is older
+    than MIRROR_THROUGHPUT_MAX_AGE. Returns (server, score) pairs, best
+    first.
+    """
+    history = MirrorHistory()
+    lock = threading.Lock()
+    scored = {}
+
+    def on_result(server, status, sample, stats):
+        with lock:
+            score = history.record(server, status, sample, timeout, stats)
+            if status == "ok":
+                scored[server] = score
+
+    try:
+        candidates, full_sweep = history.candidates(servers, num_mirrors)
+        if full_sweep:
+            log.append(f"[{name}] No usable history, probing all mirrors")
+        else:
+            log.append(
+                f"[{name}] Re-probing {len(candidates)} of {len(servers)} "
+                "mirrors from history"
+            )
+
+        known = history.throughputs(candidates)
+        if known:
+            log.append(f"[{name}] Reusing recent throughput of {len(known)} mirrors")
+        ranked = rank_mirrors_native(
+            candidates,
+            num_mirrors,
+            timeout,
+            on_result=on_result,
+            cancel=cancel,
+            known=known,
+        )
+    finally:
+        history.close()
+
+    if not scored:
+        if ranked:
+            log.append(f"[{name}] No throughput sample finished, ranked by latency")
+        return ranked
+    ranked = sorted(scored.items(), key=lambda item: item[1])
+    return ranked[:num_mirrors]
+
+
+def format_ranked_mirrorlist(ranked):
+    """Ranked (server, score) pairs in mirrorlist format"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    lines = [f"# Ranked by FullUpgrade.py on {timestamp}"]
+    for server, elapsed in ranked:
+        lines.append(f"# {elapsed:.3f}s")
+        lines.append(f"Server = {_server_url(server)}")
+    return "\n".join(lines) + "\n"
+
+
+def write_ranked_mirrorlist(path, ranked):
+    """Write ranked (server, score) pairs in mirrorlist format"""
+    text = format_ranked_mirrorlist(ranked)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.chmod(path, 0o644)
+    return text
+
+
+# ============================================================
+# PACMAN LOCAL DATABASE
+# ============================================================
+
+_DEP_NAME = re.compile(r"[<>=:]")
+
+
+def _dep_name(dep):
+    """Strip version constraints and descriptions from a dependency"""
+    return sys.intern(_DEP_NAME.split(dep, 1)[0].strip())
+
+
+def _read_db_sections(path):
+    """Parse a pacman db file into {"%SECTION%": [values]}"""
+    sections = {}
+    current = None
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith("%") and line.endswith("%"):
+                current = sections.setdefault(line, [])
+            elif line and current is not None:
+                current.append(line)
+    return sections
+
+
+class LocalPackage:
+    """One installed package as recorded in the local database"""
+
+    __slots__ = ("name", "version", "explicit", "depends", "optdepends", "provides")
+
+    def __init__(self, sections):
+        self.name = sys.intern(sections["%NAME%"][0])
+        self.version = sections["%VERSION%"][0]
+        # %REASON% is 1 for dependencies and absent for explicit installs
+        self.explicit = sections.get("%REASON%", ["0"])[0] != "1"
+        self.depends = tuple(_dep_name(dep) for dep in sections.get("%DEPENDS%", ()))
+        self.optdepends = tuple(
+            _dep_name(dep) for dep in sections.get("%OPTDEPENDS%", ())
+        )
+        self.provides = tuple(
+            _dep_name(dep) for dep in sections.get("%PROVIDES%", ())
+        )
+
+
+class LocalPackageDB:
+    """
+    In-memory model of /var/lib/pacman/local built from the desc files,
+    answering the questions the script used to ask pacman. File lists
+    are only read when a file-ownership query needs them.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or PACMAN_LOCAL_DB
+        self.packages = {}
+        self.dirs = {}
+        self.providers = {}
+        self._owners = None
+
+        for entry in os.scandir(self.path):
+            desc = os.path.join(entry.path, "desc")
+            if not entry.is_dir() or not os.path.isfile(desc):
+                continue
+            pkg = LocalPackage(_read_db_sections(desc))
+            self.packages[pkg.name] = pkg
+            self.dirs[pkg.name] = entry.path
+            for provided in (pkg.name,) + pkg.provides:
+                self.providers.setdefault(provided, set()).add(pkg.name)
+
+    def __contains__(self, name):
+        return name in self.packages
+
+    def explicit(self):
+        """Names of explicitly installed packages (pacman -Qeq)"""
+        return sorted(name for name, pkg in self.packages.items() if pkg.explicit)
+
+    def required(self, optdepends=True):
+        """
+        Names of packages some installed package depends on, or
+        optionally depends on unless optdepends is False
+        """
+        needed = set()
+        for pkg in self.packages.values():
+            deps = pkg.depends + pkg.optdepends if optdepends else pkg.depends
+            for dep in deps:
+                needed.update(self.providers.get(dep, ()))
+        return needed
+
+    def orphans(self, optional=False):
+        """
+        Dependencies no installed package requires or optionally
+        requires (pacman -Qdtq). With optional=True, optional
+        dependencies do not count as required (-Qdttq).
+        """
+        needed = self.required(optdepends=not optional)
+        return sorted(
+            name
+            for name, pkg in self.packages.items()
+            if not pkg.explicit and name not in needed
+        )
+
+    def files(self, name):
+        """Paths owned by a package, relative to / as pacman stores them"""
+        path = os.path.join(self.dirs[name], "files")
+        try:
+            return _read_db_sections(path).get("%FILES%", [])
+        except OSError:
+            return []
+
+    def owner(self, path):
+        """Name of the package owning a file (pacman -Qoq), or None"""
+        if self._owners is None:
+            self._owners = {}
+            for name in self.packages:
+                for owned in self.files(name):
+                    if not owned.endswith("/"):
+                        self._owners[owned] = name
+        return self._owners.get(path.lstrip("/"))
+
+
+# ============================================================
+# PACKAGE CACHE PRUNER
+# ============================================================
+
+
+def _is_alpha(ch):
+    return ("a" <= ch <= "z") or ("A" <= ch <= "Z")
+
+
+def _is_digit(ch):
+    return "0" <= ch <= "9"
+
+
+def rpmvercmp(a, b):
+    """Compare two version segments exactly like libalpm's rpmvercmp"""
+    if a == b:
+        return 0
+
+    one = two = 0  # current positions
+    ptr1 = ptr2 = 0  # ends of the previous segments
+    len1, len2 = len(a), len(b)
+
+    while one < len1 and two < len2:
+        while one < len1 and not (_is_alpha(a[one]) or _is_digit(a[one])):
+            one += 1
+        while two < len2 and not (_is_alpha(b[two]) or _is_digit(b[two])):
+            two += 1
+        if one >= len1 or two >= len2:
+            break
+
+        # Different separator lengths decide on their own
+        if one - ptr1 != two - ptr2:
+            return -1 if one - ptr1 < two - ptr2 else 1
+
+        ptr1, ptr2 = one, two
+        isnum = _is_digit(a[ptr1])
+        same_kind = _is_digit if isnum else _is_alpha
+        while ptr1 < len1 and same_kind(a[ptr1]):
+            ptr1 += 1
+        while ptr2 < len2 and same_kind(b[ptr2]):
+            ptr2 += 1
+
+        # Numeric segments are always newer than alpha ones
+        if two == ptr2:
+            return 1 if isnum else -1
+
+        seg1, seg2 = a[one:ptr1], b[two:ptr2]
+        if isnum:
+            seg1, seg2 = seg1.lstrip("0"), seg2.lstrip("0")
+            if len(seg1) != len(seg2):
+                return 1 if len(seg1) > len(seg2) else -1
+        if seg1 != seg2:
+            return 1 if seg1 > seg2 else -1
+
+        one, two = ptr1, ptr2
+
+    if one >= len1 and two >= len2:
+        return 0
+
+    # A remaining alpha string never beats an empty one
+    if (one >= len1 and not (two < len2 and _is_alpha(b[two]))) or (
+        one < len1 and _is_alpha(a[one])
+    ):
+        return -1
+    return 1
+
+
+def _parse_evr(version):
+    """Split [epoch:]pkgver[-pkgrel] the way libalpm does"""
+    end = 0
+    while end < len(version) and _is_digit(version[end]):
+        end += 1
+    if end < len(version) and version[end] == ":":
+        epoch, rest = version[:end] or "0", version[end + 1 :]
+    else:
+        epoch, rest = "0", version
+    if "-" in rest:
+        pkgver, pkgrel = rest.rsplit("-", 1)
+    else:
+        pkgver, pkgrel = rest, None
+    return epoch, pkgver, pkgrel
+
+
+def vercmp(a, b):
+    """Compare full package versions like pacman's vercmp: -1, 0 or 1"""
+    if a == b:
+        return 0
+    epoch1, ver1, rel1 = _parse_evr(a)
+    epoch2, ver2, rel2 = _parse_evr(b)
+    ret = rpmvercmp(epoch1, epoch2)
+    if ret == 0:
+        ret = rpmvercmp(ver1, ver2)
+        if ret == 0 and rel1 is not None and rel2 is not None:
+            ret = rpmvercmp(rel1, rel2)
+    return ret
+
+
+_PKG_FILE = re.compile(
+    r"^(?P<name>.+)-(?P<version>[^-]+-[^-]+)-(?P<arch>[^-]+)"
+    r"\.pkg\.tar(?:\.[a-z0-9]+)?(?P<sig>\.sig)?$"
+)
+
+
+def plan_cache_prune(cache_dir=None, keep=None, keep_installed=None):
+    """
+    Scan the package cache once and pick the files to delete: all but
+    the newest `keep` versions of each uninstalled package, and of each
+    installed one only if `keep_installed` (or PKG_CACHE_KEEP_INSTALLED)
+    is set. Signatures go with their package. Returns a list of
+    (path, size).
+    """
+    import functools
+
+    cache_dir = cache_dir or PKG_CACHE_DIR
+    keep = PKG_CACHE_KEEP if keep is None else keep
+    if keep_installed is None:
+        keep_installed = PKG_CACHE_KEEP_INSTALLED
+    installed = set(installed_package_names())
+
+    # (name, arch) -> version -> [(path, size)] for the package and its .sig
+    groups = {}
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            match = _PKG_FILE.match(entry.name)
+            if not match or not entry.is_file(follow_symlinks=False):
+                continue
+            key = (match.group("name"), match.group("arch"))
+            files = groups.setdefault(key, {}).setdefault(match.group("version"), [])
+            files.append((entry.path, entry.stat(follow_symlinks=False).st_size))
+
+    doomed = []
+    newest_first = functools.cmp_to_key(lambda a, b: vercmp(b, a))
+    for (name, _), versions in groups.items():
+        limit = keep_installed if name in installed else keep
+        if limit is None:
+            continue
+        for version in sorted(versions, key=newest_first)[limit:]:
+            doomed.extend(versions[version])
+    return doomed
+
+
+def prune_package_cache(cache_dir=None, keep=None, keep_installed=None, workers=8):
+    """
+    Delete old package cache files in parallel.
+    Returns (files_removed, bytes_reclaimed), counting only successes.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    doomed = plan_cache_prune(cache_dir, keep, keep_installed)
+
+    def unlink(item):
+        path, size = item
+        try:
+            os.unlink(path)
+            return size
+        except OSError as e:
+            log_error(f"Failed to remove {path}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        freed = [size for size in pool.map(unlink, doomed) if size is not None]
+    return len(freed), sum(freed)
+
+
+# ============================================================
+# AUR UPDATE CHECK
+# ============================================================
+
+
+def sync_package_names(sync_dir=None):
+    """
+    Names of every package in the sync databases, read from the entry
+    names of the database archives. Returns None if a database cannot
+    be read (e.g. a compression tarfile does not support).
+    """
+    import tarfile
+
+    sync_dir = sync_dir or os.path.join(os.path.dirname(PACMAN_LOCAL_DB), "sync")
+    names = set()
+    try:
+        entries = [e for e in os.scandir(sync_dir) if e.name.endswith(".db")]
+    except FileNotFoundError:
+        return names
+    try:
+        for entry in entries:
+            with tarfile.open(entry.path) as db:
+                for member in db:
+                    if member.isdir():
+                        # Entries are <name>-<pkgver>-<pkgrel>/
+                        names.add(member.name.rstrip("/").rsplit("-", 2)[0])
+    except (OSError, tarfile.TarError):
+        return None
+    return names
+
+
+def foreign_packages(db=None):
+    """
+    Installed packages found in no sync database, like pacman -Qm, as
+    {name: version}. Falls back to pacman -Qm itself if the local
+    database cannot be read.
+    """
+    try:
+        db = db or LocalPackageDB()
+    except OSError as e:
+        log_info(f"Local database unreadable ({e}), asking pacman -Qm")
+        ret, out, _ = run_command(
+            ["pacman", "-Qm"], capture_output=True, check_error=False
+        )
+        if ret != 0:
+            return {}
+        return dict(line.split(None, 1) for line in out.splitlines() if " " in line)
+    synced = sync_package_names()
+    if synced is None:
+        ret, out, _ = run_command(
+            ["pacman", "-Qmq"], capture_output=True, check_error=False
+        )
+        names = set(out.split()) if ret in (0, 1) else set()
+    else:
+        names = set(db.packages) - synced
+    return {name: db.packages[name].version for name in names if name in db}
+
+
+def _aur_rpc_info(names, pool, timeout):
+    """One batched RPC info request; returns {name: version}"""
+    import http.client
+    import urllib.parse
+
+    url = urllib.parse.urlsplit(AUR_RPC_URL)
+    body = urllib.parse.urlencode([("arg[]", name) for name in names])
+    conn = pool.get(url.scheme, url.netloc, timeout)
+    try:
+        conn.request(
+            "POST",
+            url.path,
+            body=body,
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+                "User-Agent": "FullUpgrade",
+            },
+        )
+        resp = conn.getresponse()
+        data = resp.read()
+    except Exception:
+        conn.close()
+        raise
+    if resp.will_close:
+        conn.close()
+    else:
+        pool.put(url.scheme, url.netloc, conn)
+
+    if resp.status != 200:
+        raise http.client.HTTPException(f"AUR RPC: HTTP {resp.status}")
+    reply = json.loads(data)
+    if reply.get("type") == "error":
+        raise ValueError(f"AUR RPC: {reply.get('error')}")
+    return {pkg["Name"]: pkg["Version"] for pkg in reply.get("results", [])}
+
+
+def aur_versions(names, timeout=15, now=None):
+    """
+    Latest AUR version of each package, None for packages not in the
+    AUR. Answers younger than AUR_CACHE_TTL come from AUR_CACHE; the
+    rest are asked in batches of AUR_RPC_BATCH over one connection.
+    """
+    now = now or time.time()
+    cache = _load_json(AUR_CACHE, {})
+    versions = {}
+    missing = []
+    for name in names:
+        cached = cache.get(name)
+        if cached and now - cached["fetched"] <= AUR_CACHE_TTL:
+            versions[name] = cached["version"]
+        else:
+            missing.append(name)
+
+    pool = ConnectionPool()
+    try:
+        for i in range(0, len(missing), AUR_RPC_BATCH):
+            batch = missing[i : i + AUR_RPC_BATCH]
+            found = _aur_rpc_info(batch, pool, timeout)
+            for name in batch:
+                versions[name] = found.get(name)
+                cache[name] = {"version": found.get(name), "fetched": now}
+    finally:
+        pool.close()
+
+    if missing:
+        cache = {
+            name: entry
+            for name, entry in cache.items()
+            if now - entry["fetched"] <= AUR_CACHE_TTL
+        }
+        try:
+            _write_atomic(AUR_CACHE, json.dumps(cache))
+        except OSError as e:
+            log_error(f"Could not save AUR cache: {e}")
+    return versions
+
+
+def aur_outdated():
+    """
+    Foreign packages with a newer AUR version, as (name, installed,
+    available) tuples. None if the AUR could not be asked.
+    """
+    import http.client
+
+    installed = foreign_packages()
+    try:
+        available = aur_versions(sorted(installed))
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        log_error(f"AUR update check failed: {e}")
+        return None
+    return [
+        (name, installed[name], available[name])
+        for name in sorted(installed)
+        if available.get(name) and vercmp(available[name], installed[name]) > 0
+    ]
+
+
+# ============================================================
+# DISK USAGE
+# ============================================================
+
+
+class DiskUsage:
+    """
+    Parallel replacement for du. Trees are walked concurrently with
+    os.scandir, sizes are allocated bytes like du reports, and files
+    with several hard links are counted once.
+
+    What each directory holds itself is cached against its mtime, so a
+    repeated measurement only rescans directories whose entries
+    changed. A file shrinking in place does not touch its directory's
+    mtime; code that truncates or rewrites files calls invalidate().
+    """
+
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.lock = threading.Lock()
+        # dir -> (mtime_ns, own bytes, {(dev, ino): bytes} of hard links, subdirs)
+        self.cache = {}
+
+    def invalidate(self, path):
+        """Forget cached results for path and everything below it"""
+        path = os.path.abspath(path)
+        if not os.path.isdir(path):
+            path = os.path.dirname(path)
+        prefix = path.rstrip("/") + "/"
+        with self.lock:
+            for cached in list(self.cache):
+                if cached == path or cached.startswith(prefix):
+                    del self.cache[cached]
+
+    def _scan_dir(self, path):
+        """Return (own_bytes, linked, subdirs) for one directory"""
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return 0, {}, []
+
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached and cached[0] == st.st_mtime_ns:
+            return cached[1:]
+
+        own = st.st_blocks * 512
+        linked = {}
+        subdirs = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+                            continue
+                        est = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    size = est.st_blocks * 512
+                    if est.st_nlink > 1:
+                        linked[(est.st_dev, est.st_ino)] = size
+                    else:
+                        own += size
+        except OSError:
+            pass
+
+        with self.lock:
+            self.cache[path] = (st.st_mtime_ns, own, linked, subdirs)
+        return own, linked, subdirs
+
+    def measure(self, root):
+        """
+        Measure a tree. Returns (total_bytes, {child: bytes}) where the
+        breakdown holds each immediate subdirectory of root and "." for
+        the files directly in it.
+        """
+        from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+        root = os.path.abspath(root)
+        breakdown = {}
+        seen = set()
+
+        def bucket(path):
+            if path == root:
+                return "."
+            return os.path.relpath(path, root).split(os.sep, 1)[0]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = {pool.submit(self._scan_dir, root): root}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    own, linked, subdirs = future.result()
+                    name = bucket(path)
+                    size = own
+                    for key, linked_size in linked.items():
+                        if key not in seen:
+                            seen.add(key)
+                            size += linked_size
+                    breakdown[name] = breakdown.get(name, 0) + size
+                    for subdir in subdirs:
+                        pending[pool.submit(self._scan_dir, subdir)] = subdir
+
+        return sum(breakdown.values()), breakdown
+
+
+def log_usage_change(label, before, after):
+    """Log how much a cleanup step reclaimed, per subdirectory"""
+    (total_before, parts_before), (total_after, parts_after) = before, after
+    log_info(
+        f"{label}: {format_bytes(total_before)} -> {format_bytes(total_after)} "
+        f"(reclaimed {format_bytes(total_before - total_after)}, "
+        f"{total_before - total_after} bytes)"
+    )
+    for name in sorted(set(parts_before) | set(parts_after)):
+        delta = parts_before.get(name, 0) - parts_after.get(name, 0)
+        if delta:
+            sign = "-" if delta > 0 else "+"
+            log_output(f"  {name}: {sign}{format_bytes(abs(delta))}")
+
+
+# ============================================================
+# COREDUMP / TEMP CLEANUP
+# ============================================================
+
+
+def _bound_sockets():
+    """
+    (dev, ino) of the unix socket files processes are bound to. An open
+    socket's /proc/<pid>/fd entry is a sockfs inode, not the file on
+    disk, so the paths come from /proc/net/unix.
+    """
+    inodes = set()
+    try:
+        with open("/proc/net/unix", encoding="utf-8", errors="replace") as f:
+            lines = f.readlines()[1:]
+    except OSError:
+        return inodes
+    for line in lines:
+        fields = line.split(maxsplit=7)
+        # Abstract sockets ("@name") have no file
+        if len(fields) < 8 or not fields[7].startswith("/"):
+            continue
+        try:
+            st = os.stat(fields[7].rstrip("\n"))
+        except OSError:
+            continue
+        inodes.add((st.st_dev, st.st_ino))
+    return inodes
+
+
+def _open_inodes():
+    """
+    (dev, ino) of every file held open by a running process or bound as
+    a unix socket, plus the working directories of all processes
+    """
+    inodes = _bound_sockets()
+    cwds = set()
+    try:
+        pids = [pid for pid in os.listdir("/proc") if pid.isdigit()]
+    except OSError:
+        return inodes, cwds
+
+    for pid in pids:
+        try:
+            cwds.add(os.readlink(f"/proc/{pid}/cwd"))
+            fds = os.listdir(f"/proc/{pid}/fd")
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                st = os.stat(f"/proc/{pid}/fd/{fd}")
+            except OSError:
+                continue
+            inodes.add((st.st_dev, st.st_ino))
+    return inodes, cwds
+
+
+def _inspect_entry(path):
+    """
+    Return (bytes, newest_mtime, inodes) for a top-level entry,
+    descending into directories
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return 0, 0, set()
+
+    size = st.st_blocks * 512
+    newest = st.st_mtime
+    inodes = {(st.st_dev, st.st_ino)}
+    if not os.path.isdir(path) or os.path.islink(path):
+        return size, newest, inodes
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        for name in dirnames + filenames:
+            try:
+                est = os.lstat(os.path.join(dirpath, name))
+            except OSError:
+                continue
+            size += est.st_blocks * 512
+            newest = max(newest, est.st_mtime)
+            inodes.add((est.st_dev, est.st_ino))
+    return size, newest, inodes
+
+
+def _matching_policy(dir_path, name, size, age):
+    """First cleanup policy of dir_path that selects an entry, or None"""
+    for policy in CLEANUP_POLICIES:
+        if dir_path not in policy["dirs"]:
+            continue
+        if age < policy.get("min_age", 0) or size < policy.get("min_size", 0):
+            continue
+        if any(fnmatch.fnmatch(name, pat) for pat in policy.get("patterns", ["*"])):
+            return policy
+    return None
+
+
+def plan_cleanup(dirs=None, workers=8):
+    """
+    Scan the cleanup directories in parallel and decide, per top-level
+    entry, which policy deletes it. Entries in CLEANUP_EXCLUDE, in use
+    by a process (open file or working directory) or matching no policy
+    are kept. A directory's age is that of its newest file.
+    Returns a list of (path, bytes, policy_name).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    dirs = dirs or sorted({d for policy in CLEANUP_POLICIES for d in policy["dirs"]})
+    open_inodes, cwds = _open_inodes()
+    now = time.time()
+
+    entries = []
+    for dir_path in dirs:
+        try:
+            with os.scandir(dir_path) as it:
+                entries.extend((dir_path, entry.name, entry.path) for entry in it)
+        except OSError:
+            continue
+
+    def decide(item):
+        dir_path, name, path = item
+        if any(fnmatch.fnmatch(name, pat) for pat in CLEANUP_EXCLUDE):
+            return None
+        if any(cwd == path or cwd.startswith(path + "/") for cwd in cwds):
+            return None
+        size, newest, inodes = _inspect_entry(path)
+        if inodes & open_inodes:
+            return None
+        policy = _matching_policy(dir_path, name, size, now - newest)
+        return (path, size, policy["name"]) if policy else None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [item for item in pool.map(decide, entries) if item]
+
+
+def summarize_cleanup(plan):
+    """Bytes and entry count per policy name"""
+    summary = {}
+    for _, size, policy in plan:
+        total, count = summary.get(policy, (0, 0))
+        summary[policy] = (total + size, count + 1)
+    return summary
+
+
+def apply_cleanup(plan, workers=8, batch_size=64):
+    """
+    Delete planned entries in batches on a worker pool.
+    Returns {policy_name: bytes actually freed}.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def delete_batch(batch):
+        freed = {}
+        for path, size, policy in batch:
+            try:
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+            except OSError as e:
+                log_error(f"Failed to remove {path}: {e}")
+                continue
+            freed[policy] = freed.get(policy, 0) + size
+        return freed
+
+    batches = [plan[i : i + batch_size] for i in range(0, len(plan), batch_size)]
+    totals = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for freed in pool.map(delete_batch, batches):
+            for policy, size in freed.items():
+                totals[policy] = totals.get(policy, 0) + size
+    return totals
+
+
+# ============================================================
+# LOG ROTATION
+# ============================================================
+
+
+def find_large_logs(root=None, budget=None, max_depth=2):
+    """
+    Active *.log files under root larger than the size budget, as
+    (path, size) pairs, largest first
+    """
+    root = root or LOG_ROOT
+    budget = LOG_SIZE_BUDGET if budget is None else budget
+    found = []
+
+    def scan(path, depth):
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if depth < max_depth:
+                            scan(entry.path, depth + 1)
+                    elif entry.name.endswith(".log") and entry.is_file(
+                        follow_symlinks=False
+                    ):
+                        size = entry.stat(follow_symlinks=False).st_size
+                        if size > budget:
+                            found.append((entry.path, size))
+        except OSError:
+            pass
+
+    scan(root, 1)
+    return sorted(found, key=lambda item: item[1], reverse=True)
+
+
+def _line_boundary(f, offset):
+    """First offset at or after `offset` that starts a new line"""
+    if offset <= 0:
+        return 0
+    f.seek(offset - 1)
+    while True:
+        chunk = f.read(64 * 1024)
+        if not chunk:
+            return f.tell()
+        newline = chunk.find(b"\n")
+        if newline >= 0:
+            return f.tell() - len(chunk) + newline + 1
+
+
+def archive_log_head(path, budget=None, compress=None):
+    """
+    Prepare shrinking a log to its newest `budget` bytes while its
+    writer is still running: find the cut on a line boundary and, if
+    compressing, stream everything before it into <log>.1.gz.
+    Returns (cut_offset, archive_path or None).
+    """
+    budget = LOG_SIZE_BUDGET if budget is None else budget
+    compress = LOG_ROTATE_COMPRESS if compress is None else compress
+
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        cut = _line_boundary(f, max(0, f.tell() - budget))
+        if not compress or cut == 0:
+            return cut, None
+
+        import gzip
+
+        archive = f"{path}.1.gz"
+        f.seek(0)
+        remaining = cut
+        with gzip.open(f"{archive}.tmp", "wb") as out:
+            while remaining:
+                chunk = f.read(min(1024 * 1024, remaining))
+                if not chunk:
+                    break
+                out.write(chunk)
+                remaining -= len(chunk)
+        os.replace(f"{archive}.tmp", archive)
+        return cut, archive
+
+
+def drop_log_head(path, cut):
+    """
+    Shift everything from `cut` to the end (including lines appended
+    since the cut was chosen) to the start of the file and truncate.
+    Only the kept tail is copied, so this is the short step that runs
+    with the logging services stopped.
+    """
+    with open(path, "r+b") as f:
+        f.seek(cut)
+        tail = f.read()
+        f.seek(0)
+        f.write(tail)
+        f.truncate()
+
+
+# ============================================================
+# JOURNAL MEASUREMENT
+# ============================================================
+
+_JOURNAL_SIGNATURE = b"LPKSHHRH"
+# Offset of tail_entry_boot_id in the journal file header
+_JOURNAL_BOOT_ID_OFFSET = 56
+
+
+def measure_journal(journal_dir=None):
+    """
+    Measure the journal directly from its files.
+    Returns {"total", "oldest_mtime", "files": [(path, bytes)],
+    "boots": {boot_id: bytes}} with sizes as allocated bytes.
+    """
+    journal_dir = journal_dir or JOURNAL_DIR
+    files = []
+    boots = {}
+    oldest = None
+
+    for dirpath, _, filenames in os.walk(journal_dir):
+        for name in filenames:
+            if not (name.endswith(".journal") or name.endswith(".journal~")):
+                continue
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+                with open(path, "rb") as f:
+                    header = f.read(_JOURNAL_BOOT_ID_OFFSET + 16)
+            except OSError:
+                continue
+
+            size = st.st_blocks * 512
+            files.append((path, size))
+            oldest = st.st_mtime if oldest is None else min(oldest, st.st_mtime)
+            if header[:8] == _JOURNAL_SIGNATURE and len(header) == 72:
+                boot_id = header[_JOURNAL_BOOT_ID_OFFSET:].hex()
+            else:
+                boot_id = "unknown"
+            boots[boot_id] = boots.get(boot_id, 0) + size
+
+    return {
+        "total": sum(size for _, size in files),
+        "oldest_mtime": oldest,
+        "files": sorted(files, key=lambda item: item[1], reverse=True),
+        "boots": boots,
+    }
+
+
+def journal_vacuum_args(journal, now=None):
+    """
+    journalctl vacuum arguments for the configured budget and
+    retention, or None when the journal is already within both
+    """
+    now = now or time.time()
+    over_budget = journal["total"] > JOURNAL_BUDGET
+    too_old = (
+        JOURNAL_RETENTION is not None
+        and journal["oldest_mtime"] is not None
+        and now - journal["oldest_mtime"] > JOURNAL_RETENTION
+    )
+    if not over_budget and not too_old:
+        return None
+
+    args = []
+    if over_budget:
+        args.append(f"--vacuum-size={JOURNAL_VACUUM_TARGET}")
+    if too_old:
+        args.append(f"--vacuum-time={int(JOURNAL_RETENTION)}s")
+    return args
+
+
+# ============================================================
+# UPDATE DETECTION
+# ============================================================
+
+
+def _refresh_state():
+    return _load_json(REFRESH_STATE, {})
+
+
+def record_refresh(source, **fields):
+    """Merge fields (e.g. refreshed=time) into source's refresh state"""
+    with _refresh_lock:
+        state = _refresh_state()
+        state.setdefault(source, {}).update(fields)
+        try:
+            _write_atomic(REFRESH_STATE, json.dumps(state, indent=2) + "\n")
+        except OSError as e:
+            log_error(f"Could not save refresh state: {e}")
+
+
+def _checkupdates_dbpath():
+    """
+    Prepare CHECKUPDATES_DB, a private copy of the sync databases next
+    to a link to the local one, for use with pacman --dbpath. Returns
+    its path, or None if it cannot be set up.
+    """
+    db_path = CHECKUPDATES_DB
+    sync_dir = os.path.join(db_path, "sync")
+    local = os.path.join(db_path, "local")
+    try:
+        os.makedirs(sync_dir, exist_ok=True)
+        if os.path.lexists(local) and (
+            not os.path.islink(local) or os.readlink(local) != PACMAN_LOCAL_DB
+        ):
+            os.unlink(local)
+        if not os.path.lexists(local):
+            os.symlink(PACMAN_LOCAL_DB, local)
+    except OSError as e:
+        log_error(f"Cannot prepare {db_path}: {e}")
+        return None
+
+    # Seed from the system databases so only changed ones are downloaded
+    if not os.listdir(sync_dir):
+        system_sync = os.path.join(os.path.dirname(PACMAN_LOCAL_DB), "sync")
+        try:
+            for entry in os.scandir(system_sync):
+                if entry.name.endswith(".db"):
+                    shutil.copy2(entry.path, sync_dir)
+        except OSError:
+            pass
+    return db_path
+
+
+def _pending_pacman():
+    """
+    checkupdates-style: sync the private databases and ask them what
+    -Su would upgrade. The system databases are not touched, so this
+    cannot cause a partial upgrade. Returns the pending "name old ->
+    new" lines.
+    """
+    db_path = _checkupdates_dbpath()
+    if db_path is None:
+        return None
+    ret, _, _ = run_command(
+        ["pacman", "-Sy", "--dbpath", db_path, "--logfile", "/dev/null"],
+        capture_output=True,
+        check_error=False,
+    )
+    if ret != 0:
+        return None
+    # -Qu exits 1 when nothing is out of date
+    ret, out, _ = run_command(
+        ["pacman", "-Qu", "--dbpath", db_path], capture_output=True, check_error=False
+    )
+    if ret not in (0, 1):
+        return None
+    return [line for line in out.splitlines() if line.strip()]
+
+
+def _pending_aur():
+    """AUR packages with a newer version, see aur_outdated()"""
+    if not command_exists("yay"):
+        return []
+    return aur_outdated()
+
+
+def _pending_flatpak():
+    """Installed refs with an update on their remote"""
+    ret, out, _ = run_command(
+        ["flatpak", "remote-ls", "--updates", "--columns=application"],
+        capture_output=True,
+        check_error=False,
+    )
+    if ret != 0:
+        return None
+    return [line for line in out.splitlines() if line.strip()]
+
+
+def fwupd_metadata_age(now=None):
+    """
+    Seconds since the firmware metadata was last refreshed: the newer of
+    the metadata files' mtime and the last refresh this script recorded.
+    None if it was never refreshed.
+    """
+    newest = _refresh_state().get("fwupd", {}).get("refreshed")
+    for dirpath, _, filenames in os.walk(FWUPD_METADATA_DIR):
+        for name in filenames:
+            try:
+                mtime = os.stat(os.path.join(dirpath, name)).st_mtime
+            except OSError:
+                continue
+            newest = max(newest or mtime, mtime)
+    if newest is None:
+        return None
+    return (now or time.time()) - newest
+
+
+def _pending_fwupd():
+    """
+    Devices with a firmware update. Stale metadata counts as pending
+    work (it must be refreshed first) and is reported as None.
+    """
+    age = fwupd_metadata_age()
+    if age is None or age > FWUPD_METADATA_MAX_AGE:
+        return None
+    # get-updates exits 2 when there is nothing to do
+    ret, out, _ = run_command(
+        ["fwupdmgr", "get-updates", "--no-metadata-check"],
+        capture_output=True,
+        check_error=False,
+    )
+    if ret == 2:
+        return []
+    if ret != 0:
+        return None
+    return [line for line in out.splitlines() if line.strip()]
 
 
-def revert_mirrorlist_backups(mirror_dir):
-    """Revert mirrorlist backup files using shutil/os"""
-    mirror_path = Path(mirror_dir)
+_UPDATE_CHECKS = {
+    "pacman": _pending_pacman,
+    "aur": _pending_aur,
+    "flatpak": _pending_flatpak,
+    "fwupd": _pending_fwupd,
+}
 
-    if not mirror_path.exists():
-        log_error(f"Directory {mirror_dir} does not exist")
-        return False
 
-    reverted_count = 0
-    for bak_file in mirror_path.glob("*.bak"):
-        original = bak_file.with_suffix("")
-        if backup_file(str(bak_file), str(original)):
-            if set_permissions(str(original)):
-                log_info(f"Reverted: {bak_file}")
-                reverted_count += 1
-            else:
-                log_error(f"Failed to set permissions for {original}")
-        else:
-            log_error(f"Failed to revert {bak_file}")
+def pending_updates(source):
+    """
+    Pending updates for source, checked once per run: a list of items,
+    or None when the check failed or could not tell.
+    """
+    with _refresh_lock:
+        if source in _pending_work:
+            return _pending_work[source]
 
-    if reverted_count == 0:
-        log_info(f"No .bak files found to revert in {mirror_dir}")
-    else:
-        log_info(f"Reverted {reverted_count} .bak file(s).")
+    pending = _UPDATE_CHECKS[source]()
+    with _refresh_lock:
+        _pending_work[source] = pending
+    count = None if pending is None else len(pending)
+    record_refresh(source, checked=time.time(), pending=count)
+    if pending:
+        log_info(f"{source}: {len(pending)} update(s) pending")
+    return pending
 
-    return True
+
+def has_pending_work(*sources):
+    """
+    False only when every source's check positively found nothing to
+    do; a failed check counts as pending so its phase still runs.
+    """
+    return any(pending_updates(source) != [] for source in sources)
 
 
 # ============================================================
@@ -185,94 +3201,89 @@ def revert_mirrorlist_backups(mirror_dir):
 # ============================================================
 
 
-def run_rerank_task(name, cmd):
-    """Runs a named task/command in a separate process."""
-    log = []
-    log.append(f"[{name}] Starting: {' '.join(cmd) if isinstance(cmd, list) else cmd}")
-
-    ret, out, err = run_command(cmd, capture_output=True, check_error=False)
-
-    if ret == 0:
-        log.append(f"[{name}] Completed successfully")
-    else:
-        log.append(f"[{name}] Failed with return code {ret}")
+def _rankmirrors_subprocess(name, log, orig_path, timeout, num_mirrors):
+    """Rank the servers in orig_path with the external rankmirrors tool"""
+    log.append(f"[{name}] Running rankmirrors -n {num_mirrors}…")
+
+    ret, ranked, err = run_command(
+        [
+            "rankmirrors",
+            "-m",
+            str(timeout),
+            "-w",
+            "-p",
+            "-n",
+            str(num_mirrors),
+            orig_path,
+        ],
+        capture_output=True,
+        check_error=False,
+        stream=name,
+    )
 
-    return {
-        "name": name,
-        "returncode": ret,
-        "stdout": out,
-        "stderr": err,
-        "cmd": cmd,
-        "log": "\n".join(log),
-    }
+    if ret != 0:
+        raise RuntimeError(f"rankmirrors failed: {err.strip()}")
+    return ranked
 
 
-def _rank_arch_mirrors(name: str, timeout: int = 5, num_mirrors: int = 15):
+def _rank_arch_mirrors(
+    name: str, timeout: int = 5, num_mirrors: int = 15, cancel=None
+):
     """
     Download Arch Linux mirrorlist, uncomment servers, rank them,
     and save mirrorlist.pacnew. All output is logged and returned
-    for printing after all tasks finish.
+    for printing after all tasks finish. Once the `cancel` event is set
+    (the task timed out or was cancelled) nothing more is probed or
+    written.
     """
+    cancel = cancel or threading.Event()
+
+    def check_cancelled():
+        if cancel.is_set():
+            raise RuntimeError("cancelled")
+
     log = []
-    orig_path = "/etc/pacman.d/mirrorlist.orig"
-    pacnew_path = "/etc/pacman.d/mirrorlist.pacnew"
+    orig_path = f"{PACMAN_D}/mirrorlist.orig"
+    pacnew_path = f"{PACMAN_D}/mirrorlist.pacnew"
 
     # Cleanup old files
     for p in [orig_path, pacnew_path]:
         if os.path.exists(p):
             os.remove(p)
 
-    url = "https://archlinux.org/mirrorlist/all/https/"
-
     try:
-        log.append(f"[{name}] Downloading Arch mirrorlist…")
-
-        req = urllib.request.Request(url, headers={"User-Agent": "ArchMirrorRanker"})
-        with urllib.request.urlopen(req, timeout=20) as resp:
-            data = resp.read().decode("utf-8")
-
-        # Extract active mirrors
-        servers = []
-        for line in data.splitlines():
-            if line.startswith("#Server"):
-                servers.append(line[1:].strip())
-            elif line.startswith("Server"):
-                servers.append(line.strip())
+        log.append(f"[{name}] Fetching Arch mirrorlist…")
+        servers, source = fetch_arch_mirrorlist()
+        if source == "offline":
+            log.append(f"[{name}] Mirrorlist unreachable, using cached copy")
 
         # Write temporary list
         with open(orig_path, "w", encoding="utf-8") as f:
             f.write("\n".join(servers) + "\n")
         os.chmod(orig_path, 0o644)
-        log.append(f"[{name}] Downloaded {len(servers)} mirror URLs")
-
-        # Check for rankmirrors
-        if not command_exists("rankmirrors"):
-            raise RuntimeError("rankmirrors is not installed (pacman-contrib missing)")
-
-        log.append(f"[{name}] Running rankmirrors -n {num_mirrors}…")
-
-        ret, ranked, err = run_command(
-            [
-                "rankmirrors",
-                "-m",
-                str(timeout),
-                "-w",
-                "-p",
-                "-n",
-                str(num_mirrors),
-                orig_path,
-            ],
-            capture_output=True,
-            check_error=False,
-        )
+        log.append(f"[{name}] Loaded {len(servers)} mirror URLs ({source})")
 
-        if ret != 0:
-            raise RuntimeError(f"rankmirrors failed: {err.strip()}")
+        check_cancelled()
+        if MIRROR_RANKER == "native" or not command_exists("rankmirrors"):
+            log.append(
+                f"[{name}] Probing mirrors natively by {MIRROR_PROBE_MODE} "
+                f"(latency {MIRROR_CONCURRENCY} at a time, -n {num_mirrors})…"
+            )
+            ranked_servers = rank_mirrors_incremental(
+                servers, num_mirrors, timeout, log, name, cancel
+            )
+            check_cancelled()
+            if not ranked_servers:
+                raise RuntimeError("No mirror answered within the probe deadline")
+            ranked = write_ranked_mirrorlist(pacnew_path, ranked_servers)
+        else:
+            ranked = _rankmirrors_subprocess(name, log, orig_path, timeout, num_mirrors)
+            check_cancelled()
 
-        # Write final ranked output
-        with open(pacnew_path, "w", encoding="utf-8") as f:
-            f.write(ranked)
-        os.chmod(pacnew_path, 0o644)
+            # Write final ranked output
+            with open(pacnew_path, "w", encoding="utf-8") as f:
+                f.write(ranked)
+            os.chmod(pacnew_path, 0o644)
 
         mirror_count = len(
             [l for l in ranked.splitlines() if l.strip() and l.startswith("Server")]
@@ -305,77 +3316,66 @@ def _rank_arch_mirrors(name: str, timeout: int = 5, num_mirrors: int = 15):
 
 def mirrorlist():
     """Handle mirrorlist ranking for Arch and EndeavourOS"""
-    global executor, futures
-
     log_header("Mirrorlist Management")
-    if not ask_yes_no("Rerank the mirrors?", "N"):
+    if not ask_yes_no("Rerank the mirrors?", "N", key="mirrors.rerank"):
         log_info("Mirrorlist ranking skipped.")
         return None
 
-    if ask_yes_no("Revert mirrorlists from .bak files", "N"):
-        revert_mirrorlist_backups("/etc/pacman.d")
+    if ask_yes_no(
+        "Revert mirrorlists from .bak files", "N", key="mirrors.revert_backups"
+    ):
+        revert_mirrorlist_backups(PACMAN_D)
 
-    # Define parallel tasks
-    tasks = []
-
-    # 1. Arch mirrorlist ranking
-    tasks.append(
-        (
-            "arch-mirrors",
-            _rank_arch_mirrors,
-            ("arch-mirrors", 5, 30),
+    def finished(result):
+        log_info(
+            f"{result['name']}: {result['status']} "
+            f"after {result['elapsed']:.1f}s"
         )
+
+    runner = TaskRunner(
+        timeout=MIRROR_TASK_TIMEOUT,
+        on_result=finished,
+        on_line=lambda name, stream, line: log_stream(f"{name}| {line}", stream),
     )
 
+    # 1. Arch mirrorlist ranking
+    runner.add_call("arch-mirrors", _rank_arch_mirrors, "arch-mirrors", 5, 30)
+
     # 2. EndeavourOS official mirror ranking (if available)
     if command_exists("eos-rankmirrors"):
-        tasks.append(
-            (
-                "endeavouros-mirrors",
-                run_rerank_task,
-                ("endeavouros-mirrors", ["eos-rankmirrors", "--hook-rank"]),
-            )
-        )
+        runner.add_command("endeavouros-mirrors", ["eos-rankmirrors", "--hook-rank"])
     else:
         log_info("eos-rankmirrors not found, skipping EndeavourOS mirrors")
 
     # Run all tasks in parallel
-    results = []
-    log_info(f"Starting {len(tasks)} mirrorlist ranking task(s) in parallel...")
-
-    executor = ProcessPoolExecutor(max_workers=4)
-
+    log_info(f"Starting {len(runner.tasks)} mirrorlist ranking task(s) in parallel...")
     try:
-        futures = [executor.submit(func, *cmd) for name, func, cmd in tasks]
-        results = [future.result() for future in futures]
+        results = runner.run()
     except KeyboardInterrupt:
         log_error("Mirrorlist ranking interrupted!")
         raise
-    finally:
-        if executor:
-            executor.shutdown(wait=True)
 
     # Show results
     log_header("Mirrorlist Ranking Results")
 
     for result in results:
         name = result["name"]
-        print(f"\n{'='*60}")
-        print(f" Task: {name}")
-        print(f"{'='*60}")
+        log_output(f"\n{'='*60}")
+        log_output(f" Task: {name}")
+        log_output(f"{'='*60}")
 
         # Print task log
         if "log" in result and result["log"]:
-            print(result["log"])
+            log_output(result["log"])
 
         # Show ranked mirrors for arch-mirrors task
         if "arch-mirrors" in name and result["returncode"] == 0:
-            print("\nRanked mirrors:")
-            print(result["stdout"])
+            log_output("\nRanked mirrors:")
+            log_output(result["stdout"])
 
         # Show stderr if present
         if result["stderr"] and result["stderr"].strip():
-            print(f"\nErrors/Warnings:\n{result['stderr']}")
+            log_output(f"\nErrors/Warnings:\n{result['stderr']}")
 
         # Show failure status
         if result["returncode"] != 0:
@@ -384,9 +3384,9 @@ def mirrorlist():
     # Apply .pacnew files
     log_header("Applying .pacnew files")
     files = [
-        "/etc/pacman.d/mirrorlist",
-        "/etc/pacman.d/endeavouros-mirrorlist",
-        "/etc/pacman.d/hosts",
+        f"{PACMAN_D}/mirrorlist",
+        f"{PACMAN_D}/endeavouros-mirrorlist",
+        f"{PACMAN_D}/hosts",
     ]
 
     for file_path in files:
@@ -405,7 +3405,12 @@ def mirrorlist():
 
         # Cleanup old backup
         if os.path.isfile(bak_file):
-            if ask_yes_no(f"Remove old backup {bak_file}?", "N"):
+            if ask_yes_no(
+                f"Remove old backup {bak_file}?",
+                "N",
+                key="mirrors.remove_backups",
+                item=bak_file,
+            ):
                 remove_file(bak_file)
 
     log_info("All mirrorlist operations completed!")
@@ -415,68 +3420,211 @@ def mirrorlist():
 def fwupd():
     """Update firmware using fwupdmgr"""
     log_header("Firmware update (fwupdmgr)")
-    if not ask_yes_no("Update firmware with fwupdmgr", "N"):
+    if not ask_yes_no("Update firmware with fwupdmgr", "N", key="fwupd.update"):
         log_info("Firmware update skipped.")
         return None
 
-    if ask_yes_no("Revert firmware mirrorlists from .bak files", "N"):
+    if ask_yes_no(
+        "Revert firmware mirrorlists from .bak files",
+        "N",
+        key="fwupd.revert_backups",
+    ):
         revert_mirrorlist_backups("/etc/fwupd/remotes.d")
 
+    age = fwupd_metadata_age()
+    if age is not None and age <= FWUPD_METADATA_MAX_AGE:
+        log_info(f"Firmware metadata is {age / 3600:.1f}h old, not refreshing")
+        log_subheading("Updating firmware devices")
+        run_command(["fwupdmgr", "update"] + _assume_yes("-y"), check_error=False)
+        return None
+
     log_subheading("Refreshing firmware databases and syncing configs")
 
-    refresh_ret, refresh_out, refresh_err = run_command(
+    refresh_ret, _, _ = run_command(
         ["fwupdmgr", "refresh", "--force"],
         capture_output=True,
         check_error=False,
+        stream="fwupdmgr",
     )
 
-    if refresh_out:
-        print(refresh_out)
-
     if refresh_ret != 0:
         log_error("fwupdmgr refresh failed")
-        if refresh_err:
-            print(refresh_err)
         return 1
 
     log_subheading("Syncing firmware metadata")
 
-    sync_ret, sync_out, sync_err = run_command(
+    sync_ret, _, _ = run_command(
         ["fwupdmgr", "sync", "--force"],
         capture_output=True,
         check_error=False,
+        stream="fwupdmgr",
     )
 
-    if sync_out:
-        print(sync_out)
-
     if sync_ret != 0:
         log_error("fwupdmgr sync failed")
-        if sync_err:
-            print(sync_err)
         return 1
+    record_refresh("fwupd", refreshed=time.time())
 
     log_subheading("Updating firmware devices")
-    run_command(["fwupdmgr", "update"], check_error=False)
+    run_command(["fwupdmgr", "update"] + _assume_yes("-y"), check_error=False)
+    return None
+
+
+_QK_SUMMARY = re.compile(
+    r"^(\S+): (\d+) total files?, (\d+) (?:missing|altered) files?$"
+)
+
+
+def installed_package_names():
+    """List installed package names from the local pacman database"""
+    try:
+        entries = os.listdir(PACMAN_LOCAL_DB)
+    except OSError:
+        return []
+    # Entries are <name>-<pkgver>-<pkgrel>; neither version part has a dash
+    return sorted(entry.rsplit("-", 2)[0] for entry in entries if entry.count("-") >= 2)
+
+
+def scan_missing_files(deep=None, report_path=None, workers=None):
+    """
+    Run the pacman integrity check sharded across a pool of pacman
+    processes, streaming every package with missing (or, for -Qkk,
+    altered) files into one report as soon as it is seen and logging
+    progress along the way. Returns the number of such packages.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    deep = INTEGRITY_DEEP if deep is None else deep
+    report_path = report_path or MISSING_FILES_REPORT
+    workers = max(1, workers or INTEGRITY_WORKERS)
+    check = ["pacman", "-Qkk" if deep else "-Qk"]
+
+    packages = installed_package_names()
+    total = len(packages)
+    # Several small shards per worker keep the pool busy to the end
+    shard_size = max(1, -(-total // (workers * 4)))
+    shards = [packages[i : i + shard_size] for i in range(0, total, shard_size)]
+    if not shards:
+        shards = [[]]  # let pacman check everything itself
+
+    checked = 0
+    missing = 0
+    next_progress = time.monotonic() + 2
+    lock = threading.Lock()
+
+    with open(report_path, "w", encoding="utf-8") as report:
+
+        def on_line(line):
+            nonlocal checked, missing, next_progress
+            match = _QK_SUMMARY.match(line)
+            if not match:
+                return
+            with lock:
+                checked += 1
+                if match.group(3) != "0":
+                    missing += 1
+                    report.write(line + "\n")
+                    report.flush()
+                    log_output(line)
+                if time.monotonic() >= next_progress:
+                    next_progress = time.monotonic() + 2
+                    of_total = f"/{total}" if total else ""
+                    log_info(
+                        f"Checked {checked}{of_total} packages, "
+                        f"{missing} with missing files"
+                    )
+
+        # Pool threads log under the calling phase, like _run_streamed
+        phase = _phase_name()
+
+        def check_shard(shard):
+            _phase_local.name = phase
+            return stream_command(check + shard, on_line)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(check_shard, shards))
+
+    log_info(f"Checked {checked} packages, {missing} with missing files")
+    return missing
+
+
+def prefetch_packages():
+    """
+    Download the upgrade into the package cache while other phases run.
+    Like checkupdates, the databases synced for this are the private
+    ones in CHECKUPDATES_DB: an interrupted prefetch leaves the system
+    databases as they were, so it cannot cause a partial upgrade.
+    Never prompts: nothing is installed here.
+    """
+    db_path = _checkupdates_dbpath()
+    if db_path is None:
+        return 1
+    log_info("Downloading the package upgrade in the background")
+    ret, _, _ = run_command(
+        [
+            "pacman",
+            "-Syuw",
+            "--noconfirm",
+            "--dbpath",
+            db_path,
+            "--cachedir",
+            PKG_CACHE_DIR,
+            "--logfile",
+            "/dev/null",
+        ],
+        capture_output=True,
+        check_error=False,
+        stream="prefetch",
+    )
+    if ret != 0:
+        log_error(f"Package prefetch failed ({ret}); pacman will download itself")
+        return 1
+
+    _prefetched.set()
+    log_info("Package upgrade downloaded")
     return None
 
 
+def _install_prefetched_dbs():
+    """
+    Copy the sync databases the prefetch phase downloaded over the
+    system ones, so -Su upgrades to exactly what is in the cache.
+    """
+    private = os.path.join(CHECKUPDATES_DB, "sync")
+    system = os.path.join(os.path.dirname(PACMAN_LOCAL_DB), "sync")
+    for entry in os.scandir(private):
+        if entry.name.endswith((".db", ".db.sig")):
+            tmp = os.path.join(system, f".{entry.name}.tmp")
+            shutil.copy2(entry.path, tmp)
+            os.replace(tmp, os.path.join(system, entry.name))
+
+
 def pacman():
     """Update system packages with pacman"""
     log_header("Pacman package manager")
-    log_subheading("Updating pacman database")
-    run_command(["pacman", "-Syy"], check_error=False)
+    synced = False
+    if _prefetched.is_set():
+        try:
+            _install_prefetched_dbs()
+            log_info("Using the databases and packages of the prefetch phase")
+            synced = True
+        except OSError as e:
+            log_error(f"Could not install the prefetched databases: {e}")
+    if not synced:
+        log_subheading("Updating pacman database")
+        synced = run_command(["pacman", "-Syy"], check_error=False)[0] == 0
+    if synced:
+        record_refresh("pacman", refreshed=time.time())
 
     log_subheading("Checking database integrity")
     _, stdout, _ = run_command(
-        ["pacman", "-Dk"], capture_output=True, check_error=False
+        ["pacman", "-Dk"], capture_output=True, check_error=False, stream="pacman"
     )
 
     # Save to temp file
     try:
         with open("/tmp/pacman_integrity.log", "w", encoding="utf-8") as f:
             f.write(stdout)
-        print(stdout)
     except:
         pass
 
@@ -489,7 +3637,7 @@ def pacman():
             ["pgrep", "-a", "pacman"], capture_output=True, check_error=False
         )
 
-        if ask_yes_no("Check database lock", "Y"):
+        if ask_yes_no("Check database lock", "Y", key="pacman.check_lock"):
             if not pacman_running.strip():
                 log_info("Removing database lock")
                 run_command(
@@ -500,35 +3648,31 @@ def pacman():
                 log_error(f"Pacman process is running: {pacman_running}")
                 return 1
 
-        if ask_yes_no("Check missing or broken database/packages", "Y"):
+        if ask_yes_no(
+            "Check missing or broken database/packages",
+            "Y",
+            key="pacman.report_missing",
+        ):
             log_info("Generating missing files report...")
-            _, qk_output, _ = run_command(
-                ["pacman", "-Qk"], capture_output=True, check_error=False
-            )
-
-            # Filter for missing files
-            missing_lines = [
-                line
-                for line in qk_output.split("\n")
-                if "missing files" in line and line.split()[3] != "0"
-            ]
-
-            if missing_lines:
-                log_error("Missing files detected:")
-                with open("/tmp/missing_files_report.txt", "w", encoding="utf-8") as f:
-                    f.write("\n".join(missing_lines))
-                print("\n".join(missing_lines))
+            if scan_missing_files():
+                log_error(f"Missing files detected, see {MISSING_FILES_REPORT}")
             else:
                 log_info("No missing files found.")
 
-        if ask_yes_no("Try fixing missing dependencies", "Y"):
-            run_command(["pacman", "-Syu", "--needed"], check_error=False)
+        if ask_yes_no(
+            "Try fixing missing dependencies", "Y", key="pacman.fix_dependencies"
+        ):
+            run_command(
+                ["pacman", "-Syu", "--needed"] + _assume_yes(), check_error=False
+            )
 
         return 1
 
     log_info("Passed integrity check")
     log_subheading("Upgrading packages")
-    run_command(["pacman", "-Suv", "--color", "auto"], check_error=False)
+    run_command(
+        ["pacman", "-Suv", "--color", "auto"] + _assume_yes(), check_error=False
+    )
     return None
 
 
@@ -540,20 +3684,39 @@ def yay():
         return None
 
     log_subheading("Upgrading AUR packages")
-    run_command(["yay", "-Sua"], check_error=False)
+    outdated = pending_updates("aur")
+    if outdated is None:
+        run_command(["yay", "-Sua"] + _assume_yes(), check_error=False)
+    elif outdated:
+        for name, installed, available in outdated:
+            log_output(f"  {name} {installed} -> {available}")
+        run_command(
+            ["yay", "-Sa", "--needed"]
+            + [name for name, _, _ in outdated]
+            + _assume_yes(),
+            check_error=False,
+        )
+    else:
+        log_info("AUR packages are up to date")
 
     log_subheading("Cleaning up yay/pacman cache")
-    if ask_yes_no("Remove orphaned packages?", "Y"):
-        _, orphan_list, _ = run_command(
-            ["pacman", "-Qdtq"], capture_output=True, check_error=False
-        )
+    if ask_yes_no("Remove orphaned packages?", "Y", key="yay.remove_orphans"):
+        try:
+            orphans = LocalPackageDB().orphans()
+        except OSError as e:
+            log_info(f"Local database unreadable ({e}), asking pacman -Qdtq")
+            ret, out, _ = run_command(
+                ["pacman", "-Qdtq"], capture_output=True, check_error=False
+            )
+            orphans = out.split() if ret == 0 else []
 
-        if orphan_list.strip():
+        if orphans:
             log_info("Removing orphaned packages:")
-            print(orphan_list)
-            orphans = orphan_list.strip().split("\n")
-            run_command(["pacman", "-Rns"] + orphans, check_error=False)
-            run_command(["yay", "-Yc"], check_error=False)
+            log_output("\n".join(orphans))
+            run_command(
+                ["pacman", "-Rns"] + orphans + _assume_yes(), check_error=False
+            )
+            run_command(["yay", "-Yc"] + _assume_yes(), check_error=False)
             log_info("Note: /home files and configuration caches remain unaffected.")
         else:
             log_info("No orphaned packages found.")
@@ -561,25 +3724,136 @@ def yay():
         log_info("Skipping removal of orphaned packages.")
 
     show_disk_space("Before cache cleanup")
-    run_command(["paccache", "-r", "-ufv"], check_error=False)
-    run_command(["yay", "-Scc"], check_error=False)
+    try:
+        removed, reclaimed = prune_package_cache()
+        log_info(
+            f"Pruned {removed} cached package file(s), "
+            f"reclaimed {format_bytes(reclaimed)} ({reclaimed} bytes)"
+        )
+    except OSError as e:
+        log_error(f"Could not prune package cache: {e}")
+    run_command(["yay", "-Scc"] + _assume_yes(), check_error=False)
     show_disk_space("After cache cleanup")
 
 
+def _manifest_paths():
+    """Existing manifest files, in MANIFEST_FILES order"""
+    paths = [os.path.join(MANIFEST_DIR, name) for name in MANIFEST_FILES]
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def load_manifest(paths):
+    """Load package lists into one set, ignoring blanks and comments"""
+    wanted = set()
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                name = line.split("#", 1)[0].strip()
+                if name:
+                    wanted.add(name)
+    return wanted
+
+
+def _manifest_state(paths):
+    """Fingerprint of the manifests and of the installed package set"""
+    import hashlib
+
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    try:
+        local_mtime = os.stat(PACMAN_LOCAL_DB).st_mtime_ns
+    except OSError:
+        local_mtime = None
+    return {"manifest": digest.hexdigest(), "local_db": local_mtime}
+
+
+def manifest_missing(paths):
+    """
+    Diff the manifests against the installed packages (including what
+    they provide). A snapshot of the last diff is reused as long as
+    neither the manifests nor the local database have changed.
+    Returns (missing, state, from_snapshot).
+    """
+    state = _manifest_state(paths)
+    snapshot = _load_json(MANIFEST_SNAPSHOT, {})
+    if snapshot.get("state") == state:
+        return snapshot.get("missing", []), state, True
+
+    wanted = load_manifest(paths)
+    try:
+        missing = sorted(wanted - LocalPackageDB().providers.keys())
+    except OSError as e:
+        # pacman -T prints the names nothing installed satisfies
+        log_info(f"Local database unreadable ({e}), asking pacman -T")
+        ret, out, _ = run_command(
+            ["pacman", "-T"] + sorted(wanted), capture_output=True, check_error=False
+        )
+        missing = sorted(out.split()) if ret == 127 else []
+    return missing, state, False
+
+
+def reconcile_manifest():
+    """Install packages listed in the manifests but missing here"""
+    log_header("Package manifest")
+    paths = _manifest_paths()
+    if not paths:
+        log_info(f"No package manifests in {MANIFEST_DIR}")
+        return None
+
+    missing, state, from_snapshot = manifest_missing(paths)
+    if from_snapshot and not missing:
+        log_info("Manifest unchanged since last reconciliation, nothing to do.")
+        return None
+
+    if missing:
+        log_info(f"{len(missing)} manifest package(s) not installed:")
+        log_output(" ".join(missing))
+        if ask_yes_no(
+            "Install packages missing from the manifest?",
+            "N",
+            key="manifest.install_missing",
+        ):
+            # One transaction for everything; yay also resolves AUR names
+            installer = "yay" if command_exists("yay") else "pacman"
+            ret, _, _ = run_command(
+                [installer, "-S", "--needed"] + missing + _assume_yes(),
+                check_error=False,
+            )
+            if ret == 0:
+                missing, state, _ = manifest_missing(paths)
+    else:
+        log_info("All manifest packages are installed.")
+
+    try:
+        _write_atomic(
+            MANIFEST_SNAPSHOT, json.dumps({"state": state, "missing": missing})
+        )
+    except OSError as e:
+        log_error(f"Could not save manifest snapshot: {e}")
+    return None
+
+
 def flatpak():
     """Update flatpak packages"""
     log_header("Flatpak package manager")
     log_subheading("Updating flatpak packages")
-    run_command(["flatpak", "update"], check_error=False)
+    run_command(["flatpak", "update"] + _assume_yes("-y"), check_error=False)
 
-    if ask_yes_no("Remove unused flatpak packages?", "Y"):
+    if ask_yes_no(
+        "Remove unused flatpak packages?", "Y", key="flatpak.remove_unused"
+    ):
         log_info("Uninstalling unused flatpaks...")
-        run_command(["flatpak", "uninstall", "--unused"], check_error=False)
+        run_command(
+            ["flatpak", "uninstall", "--unused"] + _assume_yes("-y"),
+            check_error=False,
+        )
     else:
         log_info("Skipping unused flatpak removal.")
 
     log_subheading("Checking flatpak checksums")
-    if ask_yes_no("Check flatpak checksums?", "N"):
+    if ask_yes_no("Check flatpak checksums?", "N", key="flatpak.repair"):
         log_info("Checking flatpaks...")
         run_command(["flatpak", "repair"], check_error=False)
     else:
@@ -589,12 +3863,12 @@ def flatpak():
 def zinit():
     """Update zsh zinit plugins"""
     log_header("Update zsh shell")
-    if not ask_yes_no("Update Zinit", "N"):
+    if not ask_yes_no("Update Zinit", "N", key="zinit.update"):
         log_info("Zinit update skipped.")
         return None
 
     run_command(["zinit", "self-update"])
-    if ask_yes_no("Update zinit plugins", "Y"):
+    if ask_yes_no("Update zinit plugins", "Y", key="zinit.update_plugins"):
         run_command(["zinit", "update", "--all"])
     run_command(["zinit", "zstatus"])
     return None
@@ -604,24 +3878,32 @@ def logs_journalctl():
     """Clean system logs and journalctl"""
     log_header("Cleaning logs")
 
-    # Get log space before
-    log_space_before = "0"
-    try:
-        ret, output, _ = run_command(
-            ["du", "-sh", "/var/log"], capture_output=True, check_error=False
-        )
-        if ret == 0:
-            log_space_before = output.split()[0]
-    except:
-        pass
+    usage = DiskUsage()
+    log_space_before = log_space = usage.measure(LOG_ROOT)
 
-    if ask_yes_no("Vacuum journalctl down?", "N"):
-        log_info("Shrinking journalctl total size, and rotating logs")
-
-        run_command(["journalctl", "--sync"], check_error=False)
-        run_command(["journalctl", "--flush"], check_error=False)
-        run_command(["journalctl", "--rotate"], check_error=False)
-        run_command(["journalctl", "--vacuum-size=10M"], check_error=False)
+    if ask_yes_no("Vacuum journalctl down?", "N", key="logs.vacuum_journal"):
+        journal = measure_journal()
+        log_info(
+            f"Journal holds {format_bytes(journal['total'])} in "
+            f"{len(journal['files'])} file(s) across {len(journal['boots'])} boot(s)"
+        )
+        for boot_id, size in sorted(
+            journal["boots"].items(), key=lambda item: item[1], reverse=True
+        )[:5]:
+            log_output(f"  boot {boot_id[:12]}: {format_bytes(size)}")
+
+        vacuum_args = journal_vacuum_args(journal)
+        if vacuum_args is None:
+            log_info(
+                f"Journal is within its {format_bytes(JOURNAL_BUDGET)} budget, "
+                "skipping vacuum"
+            )
+        else:
+            log_info("Shrinking journalctl total size, and rotating logs")
+            run_command(["journalctl", "--sync"], check_error=False)
+            run_command(["journalctl", "--flush"], check_error=False)
+            run_command(["journalctl", "--rotate"], check_error=False)
+            run_command(["journalctl"] + vacuum_args, check_error=False)
 
         if command_exists("logrotate"):
             log_info("Forcing logrotate")
@@ -630,56 +3912,72 @@ def logs_journalctl():
                 check_error=False,
             )
             log_info("Removing rotated log files")
+
+        # Journal files shrink in place when rotated
+        usage.invalidate(JOURNAL_DIR)
+        log_space, previous = usage.measure(LOG_ROOT), log_space
+        log_usage_change("Journal vacuum", previous, log_space)
     else:
         log_info("Skipping journalctl vacuum")
 
-    if ask_yes_no("Shorten ACTIVE log files? (Highly invasive)", "N"):
-        log_info("Stopping rsyslog")
-        run_command(["systemctl", "stop", "rsyslog"], check_error=False)
-        run_command(["systemctl", "stop", "systemd-journald"], check_error=False)
-
-        log_info("Emptying current log files")
-        run_command(
-            [
-                "find",
-                "/var/log",
-                "-maxdepth",
-                "2",
-                "-type",
-                "f",
-                "-name",
-                "*.log",
-                "-exec",
-                "truncate",
-                "-s",
-                "0",
-                "{}",
-                "+",
-            ],
-            check_error=False,
+    if ask_yes_no(
+        "Shorten ACTIVE log files? (Highly invasive)",
+        "N",
+        key="logs.truncate_active",
+    ):
+        large_logs = find_large_logs()
+        log_info(
+            f"{len(large_logs)} log file(s) above {format_bytes(LOG_SIZE_BUDGET)}"
         )
 
-        log_info("Restarting rsyslog")
-        run_command(["systemctl", "start", "rsyslog"], check_error=False)
-        run_command(["systemctl", "start", "systemd-journald"], check_error=False)
+        # Archive old data while the services are still running
+        cuts = []
+        archives = set()
+        for path, size in large_logs:
+            try:
+                cut, archive = archive_log_head(path)
+            except OSError as e:
+                log_error(f"Failed to archive {path}: {e}")
+                continue
+            if archive:
+                archives.add(archive)
+            if cut:
+                cuts.append((path, cut))
+                log_info(f"{path}: {format_bytes(size)}, dropping {format_bytes(cut)}")
+
+        if cuts:
+            log_info("Stopping rsyslog")
+            run_command(["systemctl", "stop", "rsyslog"], check_error=False)
+            run_command(["systemctl", "stop", "systemd-journald"], check_error=False)
+
+            log_info("Shortening current log files")
+            for path, cut in cuts:
+                try:
+                    drop_log_head(path, cut)
+                except OSError as e:
+                    log_error(f"Failed to shorten {path}: {e}")
+                usage.invalidate(path)
+
+            log_info("Restarting rsyslog")
+            run_command(["systemctl", "start", "rsyslog"], check_error=False)
+            run_command(["systemctl", "start", "systemd-journald"], check_error=False)
 
         log_info("Removing rotated log files")
-        run_command(
-            [
-                "find",
-                "/var/log",
-                "-type",
-                "f",
-                "-name",
-                "*.log.*",
-                "-delete",
-            ],
-            check_error=False,
-        )
+        for dirpath, _, filenames in os.walk(LOG_ROOT):
+            for name in fnmatch.filter(filenames, "*.log.*"):
+                path = os.path.join(dirpath, name)
+                if path not in archives:
+                    try:
+                        os.unlink(path)
+                    except OSError as e:
+                        log_error(f"Failed to remove {path}: {e}")
+
+        log_space, previous = usage.measure(LOG_ROOT), log_space
+        log_usage_change("Active log truncation", previous, log_space)
     else:
         log_info("Skipping removal of current log files")
 
-    if ask_yes_no("Clear coredumps?", "N"):
+    if ask_yes_no("Clear coredumps?", "N", key="logs.clear_coredumps"):
         log_info("Cleaning coredump files...")
 
         # Detect init system
@@ -703,37 +4001,23 @@ def logs_journalctl():
                     check_error=False,
                 )
 
-        # Clean directories
-        dirs_to_clean = [
-            "/var/lib/systemd/coredump",
-            "/var/crash",
-            "/var/dumps",
-            "/var/tmp",
-            "/tmp",
-        ]
-
-        for dir_path in dirs_to_clean:
-            if os.path.isdir(dir_path):
-                log_info(f"Cleaning {dir_path}...")
-                log_info(f"Contents of {dir_path}:")
-                run_command(["ls", "-lah", dir_path], check_error=False)
-
-                if ask_yes_no(f"Delete all contents of {dir_path}?", "N"):
-                    run_command(
-                        [
-                            "find",
-                            dir_path,
-                            "-mindepth",
-                            "1",
-                            "-maxdepth",
-                            "1",
-                            "-delete",
-                        ],
-                        check_error=False,
-                    )
-                    log_info(f"Cleaned {dir_path}")
-                else:
-                    log_info(f"Skipped {dir_path}")
+        plan = plan_cleanup()
+        summary = summarize_cleanup(plan)
+        if not plan:
+            log_info("Nothing matches the cleanup policies.")
+        else:
+            log_info("Cleanup plan:")
+            for policy, (size, count) in sorted(summary.items()):
+                log_output(f"  {policy}: {count} entries, {format_bytes(size)}")
+
+            if ask_yes_no(
+                "Apply the coredump/temp cleanup plan?", "N", key="logs.apply_cleanup"
+            ):
+                freed = apply_cleanup(plan)
+                for policy, size in sorted(freed.items()):
+                    log_info(f"{policy}: freed {format_bytes(size)} ({size} bytes)")
+            else:
+                log_info("Cleanup plan not applied")
 
         # Restart service if systemd
         if init_system == "systemd":
@@ -759,18 +4043,7 @@ def logs_journalctl():
         pass
     time.sleep(1)
 
-    # Get log space after
-    log_space_after = "0"
-    try:
-        ret, output, _ = run_command(
-            ["du", "-sh", "/var/log"], capture_output=True, check_error=False
-        )
-        if ret == 0:
-            log_space_after = output.split()[0]
-    except:
-        pass
-
-    log_info(f"Log space: {log_space_before} -> {log_space_after}")
+    log_usage_change("Log space", log_space_before, usage.measure(LOG_ROOT))
 
 
 def final():
@@ -779,11 +4052,32 @@ def final():
     show_disk_space("Final disk space")
     log_info("System upgrade complete!")
 
+    report_path = _perf.save()
+    log_subheading("Phase timings")
+    for name, wall, median, flagged in _perf.regressions():
+        phase = _perf.phases[name]
+        past = f", median {median:.1f}s" if median is not None else ""
+        line = (
+            f"  {name}: {wall:.1f}s{past}, child CPU {phase['child_cpu']:.1f}s, "
+            f"peak RSS {format_bytes(phase['peak_rss'])}, "
+            f"downloaded {format_bytes(phase['downloaded'])}, "
+            f"disk {'+' if phase['disk_delta'] >= 0 else '-'}"
+            f"{format_bytes(abs(phase['disk_delta']))}"
+        )
+        log_output(line)
+        if flagged:
+            log_error(
+                f"Possible regression: {name} took {wall:.1f}s "
+                f"(median {median:.1f}s)"
+            )
+    if report_path:
+        log_info(f"Performance report: {report_path}")
+
     log_header("Reboot system")
     if not command_exists("reboot"):
         log_error("reboot command not found")
     else:
-        if ask_yes_no("Reboot now?", "N"):
+        if ask_yes_no("Reboot now?", "N", key="final.reboot"):
             log_info("Rebooting system in 10 seconds...")
             time.sleep(10)
             run_command(["reboot"])
@@ -803,61 +4097,438 @@ def ensure_root():
         os.execvp("sudo", ["sudo", sys.executable] + sys.argv)
 
 
-def main():
-    """Main entry point"""
-    global executor, futures
+def upgrade_phases():
+    """
+    Declare the upgrade phases. Anything touching the pacman database
+    is serialized through "pacman-db"; mirror ranking measures
+    bandwidth and so takes the network to itself; the coredump/temp
+    cleanup must not empty /var/tmp under a running flatpak update.
+    The package prefetch holds "pacman-db" while downloading into the
+    package cache, next to the firmware, flatpak and zinit phases. The
+    log phase truncates
+    files under /var/log and stops journald, so it takes "var-log"
+    from the pacman phases, which append to pacman.log and run hooks
+    that log to the journal.
+    """
+    mirrors = f"{PACMAN_D}/mirrorlist"
+    sync_db = os.path.join(os.path.dirname(PACMAN_LOCAL_DB), "sync")
+    return [
+        Phase(
+            "mirrorlist",
+            mirrorlist,
+            exclusive=("pacman-config", "network"),
+            inputs=(mirrors,),
+        ),
+        Phase(
+            "fwupd",
+            fwupd,
+            shared=("network",),
+            enabled=command_exists("fwupdmgr"),
+            pending=lambda: has_pending_work("fwupd"),
+            inputs=(FWUPD_METADATA_DIR,),
+        ),
+        # Declared before pacman so it takes "pacman-db" first; not a
+        # dependency, so pacman still runs if the prefetch crashes
+        Phase(
+            "prefetch",
+            prefetch_packages,
+            deps=("mirrorlist",),
+            exclusive=("pacman-db",),
+            shared=("network", "pacman-config", "var-log"),
+            enabled=PACMAN_PREFETCH and command_exists("pacman"),
+            pending=lambda: has_pending_work("pacman"),
+            inputs=(mirrors, sync_db),
+            resumed=_prefetched.set,
+        ),
+        Phase(
+            "pacman",
+            pacman,
+            deps=("mirrorlist",),
+            exclusive=("pacman-db",),
+            shared=("network", "pacman-config", "var-log"),
+            enabled=command_exists("pacman"),
+            pending=lambda: has_pending_work("pacman"),
+            inputs=(mirrors, sync_db),
+        ),
+        # Also cleans up after the pacman upgrade, so runs for either
+        Phase(
+            "yay",
+            yay,
+            deps=("pacman",),
+            exclusive=("pacman-db",),
+            shared=("network", "pacman-config", "var-log"),
+            enabled=command_exists("pacman"),
+            pending=lambda: has_pending_work("pacman", "aur"),
+            inputs=(PACMAN_LOCAL_DB,),
+        ),
+        Phase(
+            "manifest",
+            reconcile_manifest,
+            deps=("pacman", "yay"),
+            exclusive=("pacman-db",),
+            shared=("network", "pacman-config", "var-log"),
+            enabled=command_exists("pacman"),
+            inputs=(PACMAN_LOCAL_DB, *_manifest_paths()),
+        ),
+        Phase(
+            "flatpak",
+            flatpak,
+            shared=("network", "tmp"),
+            enabled=command_exists("flatpak"),
+            pending=lambda: has_pending_work("flatpak"),
+        ),
+        Phase(
+            "zinit",
+            zinit,
+            shared=("network",),
+            enabled=command_exists("zinit"),
+        ),
+        Phase(
+            "logs_journalctl",
+            logs_journalctl,
+            exclusive=("tmp", "var-log"),
+            enabled=command_exists("journalctl"),
+        ),
+    ]
+
+
+# Subcommands that run a subset of the upgrade phases
+COMMAND_PHASES = {
+    "mirrors": ("mirrorlist",),
+    "pacman": ("prefetch", "pacman"),
+    "aur": ("yay",),
+    "flatpak": ("flatpak",),
+    "firmware": ("fwupd",),
+    "zinit": ("zinit",),
+    "logs": ("logs_journalctl",),
+}
+
+# Gate questions a subcommand answers yes to: naming the command is the
+# request. An answer profile still overrides them.
+COMMAND_ANSWERS = {
+    "mirrors": ("mirrors.rerank",),
+    "firmware": ("fwupd.update",),
+    "zinit": ("zinit.update", "zinit.update_plugins"),
+}
+
+
+def _run_options(parser, subcommand=False):
+    """
+    Add the options shared by every run. On a subcommand they default
+    to SUPPRESS so they do not override the same options given before it.
+    """
+    import argparse
+
+    default = {"default": argparse.SUPPRESS} if subcommand else {}
+    parser.add_argument(
+        "--answers",
+        metavar="FILE",
+        help="JSON answer profile of question key -> yes/no",
+        **default,
+    )
+    parser.add_argument(
+        "--unattended",
+        action="store_true",
+        help=f"never prompt; unanswered questions take their default "
+        f"(reads {ANSWERS_FILE} if --answers is not given)",
+        **default,
+    )
+    parser.add_argument(
+        "--ask-first",
+        action="store_true",
+        help="answer every question before any work starts, then run unattended",
+        **default,
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="run every phase even when the update checks find nothing to do",
+        **default,
+    )
+    parser.add_argument(
+        "--paced",
+        action="store_true",
+        help="pause briefly after each log line (display only, work continues)",
+        **default,
+    )
+    parser.add_argument(
+        "--json-log",
+        metavar="FILE",
+        help=f"JSON Lines log file (default: a new file in {LOG_DIR})",
+        **default,
+    )
+    parser.add_argument(
+        "--save-answers",
+        metavar="FILE",
+        help="write the collected answers to FILE for later --answers runs",
+        **default,
+    )
+
+
+def parse_args(argv=None):
+    """
+    Parse command line arguments. Without a subcommand the whole
+    upgrade runs; a subcommand runs only its part.
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    _run_options(parser)
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="skip phases an interrupted or failed run already completed, "
+        "as long as their inputs are unchanged",
+    )
+
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    helps = {
+        "mirrors": "rank the Arch and EndeavourOS mirrors",
+        "pacman": "sync and upgrade the repository packages",
+        "aur": "upgrade AUR packages and clean up orphans and caches",
+        "flatpak": "update flatpaks",
+        "firmware": "update firmware with fwupdmgr",
+        "zinit": "update zinit and its plugins",
+        "logs": "vacuum the journal and shrink or clean logs",
+        "clean": "prune the package cache and apply the cleanup policies",
+    }
+    for name, text in helps.items():
+        sub = commands.add_parser(name, help=text, description=text)
+        _run_options(sub, subcommand=True)
+        if name == "mirrors":
+            sub.add_argument(
+                "--rank-only",
+                action="store_true",
+                help="print the ranked Arch mirrors without installing them "
+                "(no root needed)",
+            )
+    commands.add_parser(
+        "status",
+        help="show the last run, pending updates and mirrorlist (no root needed)",
+    )
+    return parser.parse_args(argv)
+
+
+def requires_root(args):
+    """Whether the parsed command changes the system"""
+    if args.command == "status":
+        return False
+    return not (args.command == "mirrors" and args.rank_only)
+
+
+def _ago(timestamp, now=None):
+    if not timestamp:
+        return "never"
+    seconds = (now or time.time()) - timestamp
+    if seconds < 3600:
+        return f"{seconds / 60:.0f}m ago"
+    if seconds < 2 * 86400:
+        return f"{seconds / 3600:.1f}h ago"
+    return f"{seconds / 86400:.0f}d ago"
+
+
+def show_status():
+    """Summarize the last run and the recorded update state, read-only"""
+    log_header("FullUpgrade status")
+    show_disk_space("Disk space")
+
+    journal = _load_json(RUN_JOURNAL)
+    if journal:
+        state = "completed" if journal.get("complete") else "incomplete"
+        log_info(f"Last run: {_ago(journal.get('started'))}, {state}")
+        for name, record in journal.get("phases", {}).items():
+            error = f" ({record['error']})" if record.get("error") else ""
+            log_output(
+                f"  {name}: {record.get('status')} "
+                f"{_ago(record.get('finished'))}{error}"
+            )
+        if not journal.get("complete"):
+            log_info("Continue it with --resume")
+    else:
+        log_info("No run recorded yet")
+
+    refresh = _load_json(REFRESH_STATE, {})
+    if refresh:
+        log_info("Update checks:")
+        for source, record in sorted(refresh.items()):
+            pending = record.get("pending")
+            pending = "unknown" if pending is None else pending
+            log_output(
+                f"  {source}: {pending} pending, checked "
+                f"{_ago(record.get('checked'))}, refreshed "
+                f"{_ago(record.get('refreshed'))}"
+            )
 
+    mirrorlist_path = f"{PACMAN_D}/mirrorlist"
     try:
-        log_header("Starting Full System Upgrade")
-        show_disk_space("Initial disk space")
+        with open(mirrorlist_path, encoding="utf-8") as f:
+            servers = parse_mirrorlist(f.read())
+        age = _ago(os.stat(mirrorlist_path).st_mtime)
+        log_info(f"Mirrorlist: {len(servers)} servers, written {age}")
+        for server in servers[:3]:
+            log_output(f"  {_server_url(server)}")
+    except OSError as e:
+        log_error(f"Cannot read {mirrorlist_path}: {e}")
+    return 0
+
+
+def rank_mirrors_only(num_mirrors=30, timeout=5):
+    """
+    Rank the Arch mirrors natively and print the result in mirrorlist
+    format. Nothing is installed and no mirror history is recorded.
+    """
+    try:
+        servers, source = fetch_arch_mirrorlist()
+    except OSError as e:
+        log_error(f"Cannot fetch the Arch mirrorlist: {e}")
+        return 1
+    log_info(f"Probing {len(servers)} mirrors ({source} list)")
+    ranked = rank_mirrors_native(servers, num_mirrors, timeout)
+    if not ranked:
+        log_error("No mirror answered within the probe deadline")
+        return 1
+    log_output(format_ranked_mirrorlist(ranked).rstrip("\n"))
+    return 0
+
+
+def clean_caches():
+    """Prune the package cache and apply the coredump/temp cleanup policies"""
+    log_header("Cleaning caches")
+    try:
+        removed, reclaimed = prune_package_cache()
+        log_info(
+            f"Pruned {removed} cached package file(s), "
+            f"reclaimed {format_bytes(reclaimed)}"
+        )
+    except OSError as e:
+        log_error(f"Could not prune package cache: {e}")
+
+    plan = plan_cleanup()
+    if not plan:
+        log_info("Nothing matches the cleanup policies.")
+        return None
+    log_info("Cleanup plan:")
+    for policy, (size, count) in sorted(summarize_cleanup(plan).items()):
+        log_output(f"  {policy}: {count} entries, {format_bytes(size)}")
+    if ask_yes_no(
+        "Apply the coredump/temp cleanup plan?", "N", key="logs.apply_cleanup"
+    ):
+        for policy, size in sorted(apply_cleanup(plan).items()):
+            log_info(f"{policy}: freed {format_bytes(size)}")
+    else:
+        log_info("Cleanup plan not applied")
+    return None
+
 
-        mirrorlist()
+def command_phases(command):
+    """The phases a subcommand runs"""
+    if command == "clean":
+        return [Phase("clean", clean_caches, exclusive=("pacman-db", "tmp"))]
+    names = COMMAND_PHASES[command]
+    return [phase for phase in upgrade_phases() if phase.name in names]
 
-        if command_exists("fwupdmgr"):
-            fwupd()
 
-        if command_exists("pacman"):
-            pacman()
-            yay()
+def main(argv=None):
+    """Main entry point"""
+    global _answers, _unattended, _skip_up_to_date
+
+    args = parse_args(argv)
+    close_timeout = None
+
+    # Read-only commands: no JSON log, performance report or journal
+    if not requires_root(args):
+        try:
+            if args.command == "status":
+                return show_status()
+            return rank_mirrors_only()
+        finally:
+            _log.close()
+
+    _log.paced = args.paced
+    _skip_up_to_date = not args.full
+    json_log = args.json_log
+    if json_log is None:
+        json_log = f"{LOG_DIR}/run-{datetime.now().strftime('%Y%m%d-%H%M%S')}.jsonl"
+    try:
+        _log.open_json(json_log)
+    except OSError as e:
+        log_error(f"Could not open JSON log {json_log}: {e}")
 
-        if command_exists("flatpak"):
-            flatpak()
+    try:
+        answers_path = args.answers
+        if answers_path is None and args.unattended and os.path.isfile(ANSWERS_FILE):
+            answers_path = ANSWERS_FILE
+        if answers_path:
+            try:
+                _answers = load_answers(answers_path)
+            except (OSError, ValueError) as e:
+                log_error(f"Could not load answer profile: {e}")
+                return 1
+        command_answers = {
+            key: True
+            for key in COMMAND_ANSWERS.get(args.command, ())
+            if key not in _answers
+        }
+        _answers.update(command_answers)
+
+        if args.ask_first:
+            collect_answers()
+        _unattended = args.unattended or args.ask_first
+
+        if args.save_answers:
+            # Only what was asked or loaded, not this run's command presets
+            saved = {
+                key: answer
+                for key, answer in _answers.items()
+                if key not in command_answers
+            }
+            _write_atomic(args.save_answers, json.dumps(saved, indent=2) + "\n")
+            log_info(f"Saved answers to {args.save_answers}")
+
+        if args.command:
+            log_header(f"Starting FullUpgrade {args.command}")
+            phases = command_phases(args.command)
+            results = run_phases(phases)
+            failed = [
+                phase.name
+                for phase in phases
+                if phase.enabled and results.get(phase.name, 1) not in (None, 0)
+            ]
+            if failed:
+                log_error(f"Failed: {', '.join(failed)}")
+            return 1 if failed else 0
 
-        if command_exists("zinit"):
-            zinit()
+        log_header("Starting Full System Upgrade")
+        show_disk_space("Initial disk space")
 
-        if command_exists("journalctl"):
-            logs_journalctl()
+        phases = upgrade_phases()
+        _journal.start(resume=args.resume)
+        run_phases(phases)
+        _journal.finish([phase.name for phase in phases if phase.enabled])
 
         return final()
 
     except KeyboardInterrupt:
-        print("\n\nInterrupted by user. Exiting...")
-        if executor:
-            # Cancel pending futures
-            for future in futures:
-                future.cancel()
-
-            # Force terminate all running processes
-            if hasattr(executor, "_processes"):
-                for _, process in executor._processes.items():
-                    try:
-                        process.terminate()
-                    except:
-                        pass
-
-            # Shutdown the executor
-            executor.shutdown(wait=False, cancel_futures=True)
+        log_output("\n\nInterrupted by user. Exiting...")
+        # Commands run by a TaskRunner sit in their own process groups
+        # and miss the terminal's SIGINT, so stop them explicitly
+        TaskRunner.cancel_all()
+        close_timeout = LOG_INTERRUPT_FLUSH
         return 130
 
     except Exception as e:
         log_error(f"Unexpected error: {e}")
         import traceback
 
-        traceback.print_exc()
+        log_output(traceback.format_exc().rstrip(), "stderr")
         return 1
 
+    finally:
+        _perf.save()
+        _log.close(close_timeout)
+
 
 if __name__ == "__main__":
-    ensure_root()
+    if requires_root(parse_args()):
+        ensure_root()
     sys.exit(main())
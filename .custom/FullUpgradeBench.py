@@ -0,0 +1,709 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for FullUpgrade.py
+
+Runs the upgrade end to end inside a throwaway sandbox: stub pacman,
+yay, flatpak, fwupdmgr, rankmirrors, journalctl, zinit (and the
+systemctl/logrotate/pgrep helpers the phases call) come first on PATH,
+a local HTTP server stands in for the Arch mirrorlist and the mirrors
+themselves, and every path constant of the script points into the
+sandbox. Each scenario runs main() unattended in a fresh process and
+reports wall time, orchestration overhead, peak memory, exit code and
+the errors logged on the failure paths. Before any scenario runs, the
+script's vercmp port is checked against known version comparisons.
+
+Apart from /tmp/pacman_integrity.log, which pacman() always writes,
+nothing outside the sandbox is touched, so it does not need root.
+
+Usage:
+  FullUpgradeBench.py                  run every scenario once
+  FullUpgradeBench.py -s baseline -r 5 run one scenario five times
+  FullUpgradeBench.py --json out.json  also write the raw results
+"""
+
+import os
+import sys
+import subprocess
+import time
+import shutil
+import argparse
+import email.utils
+import hashlib
+import importlib.util
+import json
+import resource
+import statistics
+import tarfile
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# ============================================================
+# CONFIGURATION
+# ============================================================
+
+SCRIPT = Path(__file__).resolve().parent / "FullUpgrade.py"
+
+STUBBED_COMMANDS = [
+    "pacman",
+    "yay",
+    "flatpak",
+    "fwupdmgr",
+    "rankmirrors",
+    "journalctl",
+    "zinit",
+    "systemctl",
+    "logrotate",
+    "pgrep",
+    "eos-rankmirrors",
+    "reboot",
+]
+
+# Every question is answered yes except the ones that would reach
+# outside the sandbox or end the run
+ANSWERS = {
+    "mirrors.rerank": "yes",
+    "mirrors.revert_backups": "no",
+    "mirrors.remove_backups": "yes",
+    "fwupd.update": "yes",
+    "fwupd.revert_backups": "no",
+    "pacman.check_lock": "no",
+    "pacman.report_missing": "yes",
+    "pacman.fix_dependencies": "yes",
+    "yay.remove_orphans": "yes",
+    "manifest.install_missing": "yes",
+    "flatpak.remove_unused": "yes",
+    "flatpak.repair": "yes",
+    "zinit.update": "yes",
+    "zinit.update_plugins": "yes",
+    "logs.vacuum_journal": "yes",
+    "logs.truncate_active": "yes",
+    "logs.clear_coredumps": "yes",
+    "logs.apply_cleanup": "yes",
+    "final.reboot": "no",
+}
+
+# Sandbox contents
+FIXTURE_PACKAGES = 300
+FIXTURE_ORPHANS = 5
+FIXTURE_FOREIGN = 30
+FIXTURE_CACHED_VERSIONS = 4
+FIXTURE_MIRRORS = 40
+FIXTURE_LOG_BYTES = 6 * 1024 * 1024
+
+# Stub behaviour is looked up by the longest matching command prefix,
+# e.g. "pacman -Dk" before "pacman" before "*". Fields: delay (seconds),
+# lines and line_bytes (stdout volume), output (literal stdout), stderr
+# and exit.
+DEFAULT_STUB = {"delay": 0.2, "lines": 20, "line_bytes": 80, "exit": 0}
+
+RANKED_MIRRORS = "".join(
+    f"Server = http://mirror{i}.invalid/$repo/os/$arch\n" for i in range(5)
+)
+
+# Each scenario may set "stubs" (merged over the defaults), "mirrorlist"
+# (HTTP status the mirrorlist URL answers with), "mirror_delay" (seconds
+# per mirror request), "aur_newer" (whether the AUR has updates) and
+# "constants" (FullUpgrade overrides; "{root}" expands to the sandbox) and
+# "warm_runs" (unmeasured runs in the same sandbox before the measured one)
+SCENARIOS = {
+    "baseline": {
+        "description": "every command succeeds after a short delay",
+        "stubs": {},
+    },
+    "overhead": {
+        "description": "instant stubs: wall time is orchestration only",
+        "stubs": {"*": {"delay": 0, "lines": 0}},
+    },
+    "chatty": {
+        "description": "every command prints 20000 lines",
+        "stubs": {"*": {"delay": 0, "lines": 20000, "line_bytes": 120}},
+    },
+    "native-mirrors": {
+        "description": "rank the local mirrors in-process instead of rankmirrors",
+        "constants": {"MIRROR_RANKER": "native"},
+        "mirror_delay": 0.05,
+    },
+    "mirrorlist-down": {
+        "description": "the mirrorlist URL answers 503 and nothing is cached",
+        "mirrorlist": 503,
+    },
+    "warm-cache": {
+        "description": "second run in the same sandbox: conditional mirrorlist "
+        "fetch, mirror history and update checks are warm",
+        "warm_runs": 1,
+    },
+    "noop": {
+        "description": "nothing is out of date: update checks skip the phases",
+        "stubs": {
+            "pacman -Qu": {"lines": 0, "exit": 1},
+            "flatpak remote-ls": {"lines": 0},
+            "fwupdmgr get-updates": {"lines": 0, "exit": 2},
+        },
+        "aur_newer": False,
+        "constants": {"FWUPD_METADATA_MAX_AGE": 30 * 86400},
+    },
+    "failures": {
+        "description": "broken pacman db, failing firmware/flatpak/zinit, "
+        "unreadable local db",
+        "stubs": {
+            "pacman -Dk": {"output": "error: file not found: /usr/bin/x (missing)\n"},
+            "pacman -Qk": {
+                "output": "warning: pkg0: /usr/share/pkg0/x (No such file or "
+                "directory)\npkg0: 10 total files, 1 missing file\n",
+                "exit": 1,
+            },
+            "fwupdmgr refresh": {"exit": 1, "stderr": "refresh failed\n"},
+            "flatpak": {"exit": 1, "stderr": "error: remote unreachable\n"},
+            "zinit": {"exit": 2, "stderr": "zinit: not loaded\n"},
+        },
+        "constants": {"PACMAN_LOCAL_DB": "{root}/var/lib/pacman/missing"},
+    },
+}
+
+# (a, b, vercmp(a, b)) from pacman's vercmp tests, plus an empty
+# pkgrel, which libalpm still compares; checked before any scenario
+VERCMP_VECTORS = [
+    ("1.5.0", "1.5.0", 0),
+    ("1.5.1", "1.5.0", 1),
+    ("1.5.1", "1.5", 1),
+    ("1.5.0-1", "1.5.0-2", -1),
+    ("1.5.0-2", "1.5.1-1", -1),
+    ("1.5-2", "1.5.1-1", -1),
+    ("1.5", "1.5-1", 0),
+    ("1.1-1", "1.0", 1),
+    ("1.5b-1", "1.5-1", -1),
+    ("1.5b", "1.5.1", -1),
+    ("1.0a", "1.0alpha", -1),
+    ("1.0alpha", "1.0b", -1),
+    ("1.0beta", "1.0rc", -1),
+    ("1.0rc", "1.0", -1),
+    ("1.5.a", "1.5", 1),
+    ("1.5.1", "1.5.b", 1),
+    ("1.5.b-1", "1.5.b", 0),
+    ("1.5-1", "1.5.b", -1),
+    ("2.0", "2_0", 0),
+    ("2.0_a", "2_0.a", 0),
+    ("2.0a", "2.0.a", -1),
+    ("2___a", "2_a", 1),
+    ("1:1.0", "0:1.1", 1),
+    ("1:1.0", "2:1.1", -1),
+    ("1:1.0", "0:1.0-1", 1),
+    ("0:1.0", "1.0", 0),
+    ("1:1.1", "1.1", 1),
+    ("1.0-", "1.0-1", -1),
+]
+
+# ============================================================
+# STUB COMMANDS
+# ============================================================
+
+STUB_SOURCE = '''#!{python}
+import json, os, sys, time
+
+start = time.time()
+name = os.path.basename(sys.argv[0])
+with open(os.environ["FULLUPGRADE_BENCH_STUBS"], encoding="utf-8") as f:
+    config = json.load(f)
+
+argv = [name] + sys.argv[1:]
+spec = dict(config.get("*", {{}}))
+for n in range(1, len(argv) + 1):
+    spec.update(config.get(" ".join(argv[:n]), {{}}))
+
+time.sleep(spec.get("delay", 0))
+out = sys.stdout
+if "output" in spec:
+    out.write(spec["output"])
+line = "x" * max(0, spec.get("line_bytes", 80) - 1) + "\\n"
+for i in range(spec.get("lines", 0)):
+    out.write(line)
+out.flush()
+sys.stderr.write(spec.get("stderr", ""))
+
+with open(os.environ["FULLUPGRADE_BENCH_CALLS"], "a", encoding="utf-8") as f:
+    f.write(json.dumps({{"argv": argv, "start": start, "end": time.time()}}) + "\\n")
+sys.exit(spec.get("exit", 0))
+'''
+
+
+def install_stubs(bin_dir):
+    """Write one stub executable per stubbed command into bin_dir"""
+    os.makedirs(bin_dir, exist_ok=True)
+    source = STUB_SOURCE.format(python=sys.executable)
+    for name in STUBBED_COMMANDS:
+        path = os.path.join(bin_dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(source)
+        os.chmod(path, 0o755)
+
+
+def stub_config(scenario):
+    """Default stub behaviour with the scenario's overrides merged in"""
+    config = {
+        "*": dict(DEFAULT_STUB),
+        "rankmirrors": {"output": RANKED_MIRRORS},
+        "pacman -Dk": {"output": "No database errors have been found!\n"},
+        "pacman -Qk": {"lines": 0},
+        "systemctl list-units": {"output": "systemd-coredump.socket loaded\n"},
+        "pgrep": {"lines": 0, "exit": 1},
+    }
+    for key, spec in scenario.get("stubs", {}).items():
+        config.setdefault(key, {}).update(spec)
+    return config
+
+
+# ============================================================
+# MIRROR SERVER
+# ============================================================
+
+
+class MirrorServer:
+    """
+    Local HTTP server playing the Arch mirrorlist endpoint
+    (/mirrorlist), every mirror in it (/m<N>/<repo>/os/<arch>/...) and
+    the AUR RPC info endpoint (/rpc/v5/info). The mirrorlist carries an
+    ETag and Last-Modified and answers a matching If-None-Match with
+    304; the status of every mirrorlist reply is kept in
+    `mirrorlist_replies`. Database requests honour Range and wait
+    `delay` seconds. The AUR knows every foreign fixture
+    package; those numbered by a multiple of 7 have a newer version
+    while `aur_newer` is set.
+    """
+
+    def __init__(self, mirrors=FIXTURE_MIRRORS, db_bytes=4 * 1024 * 1024):
+        self.mirrors = mirrors
+        self.db_bytes = db_bytes
+        self.status = 200
+        self.delay = 0.0
+        self.aur_newer = True
+        self.requests = 0
+        self.mirrorlist_replies = []
+        self.last_modified = email.utils.formatdate(usegmt=True)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def handle_error(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests += 1
+                if self.path.startswith("/mirrorlist"):
+                    self.send_mirrorlist()
+                else:
+                    self.send_database()
+
+            def do_POST(self):
+                server.requests += 1
+                length = int(self.headers.get("Content-Length", 0))
+                form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+                results = []
+                for name in form.get("arg[]", []):
+                    number = int(name[3:])
+                    newer = server.aur_newer and number % 7 == 0
+                    version = "9.9-1" if newer else f"1.{number}-1"
+                    results.append({"Name": name, "Version": version})
+                reply = {"type": "multiinfo", "resultcount": len(results)}
+                reply["results"] = results
+                self.send_body(200, json.dumps(reply).encode())
+
+            def send_body(self, status, body, headers=()):
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in headers:
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_mirrorlist(self):
+                if server.status != 200:
+                    server.mirrorlist_replies.append(server.status)
+                    self.send_body(server.status, b"unavailable\n")
+                    return
+                lines = ["## Arch Linux repository mirrorlist", "## Benchmark"]
+                for i in range(server.mirrors):
+                    lines.append(f"#Server = {server.url}/m{i}/$repo/os/$arch")
+                body = ("\n".join(lines) + "\n").encode()
+                etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+                headers = [("ETag", etag), ("Last-Modified", server.last_modified)]
+                status = 304 if self.headers.get("If-None-Match") == etag else 200
+                server.mirrorlist_replies.append(status)
+                self.send_body(status, body if status == 200 else b"", headers)
+
+            def send_database(self):
+                time.sleep(server.delay)
+                size = server.db_bytes
+                start, end = 0, size - 1
+                status = 200
+                if self.headers.get("Range", "").startswith("bytes="):
+                    first, _, last = self.headers["Range"][6:].partition("-")
+                    start, end = int(first), min(int(last or end), end)
+                    status = 206
+                self.send_body(status, bytes(end - start + 1))
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, *args):
+                pass
+
+        self.httpd = Server(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# ============================================================
+# SANDBOX
+# ============================================================
+
+
+def _write(path, text=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def build_sandbox(root):
+    """Populate root with the files the upgrade phases read and clean"""
+    local_db = f"{root}/var/lib/pacman/local"
+    _write(f"{local_db}/ALPM_DB_VERSION", "9\n")
+    os.makedirs(f"{root}/var/lib/pacman/sync")
+    for i in range(FIXTURE_PACKAGES):
+        orphan = i >= FIXTURE_PACKAGES - FIXTURE_ORPHANS
+        depends = "" if orphan or i == 0 else f"%DEPENDS%\npkg{i - 1}\n\n"
+        _write(
+            f"{local_db}/pkg{i}-1.{i}-1/desc",
+            f"%NAME%\npkg{i}\n\n%VERSION%\n1.{i}-1\n\n%REASON%\n"
+            f"{1 if orphan or i < FIXTURE_PACKAGES - 20 else 0}\n\n{depends}",
+        )
+        _write(f"{local_db}/pkg{i}-1.{i}-1/files", f"%FILES%\nusr/share/pkg{i}/\n")
+
+    # The last FIXTURE_FOREIGN packages are in no repo (AUR packages)
+    with tarfile.open(f"{root}/var/lib/pacman/sync/core.db", "w:gz") as db:
+        for i in range(FIXTURE_PACKAGES - FIXTURE_FOREIGN):
+            entry = tarfile.TarInfo(f"pkg{i}-1.{i}-1")
+            entry.type = tarfile.DIRTYPE
+            db.addfile(entry)
+
+    cache = f"{root}/var/cache/pacman/pkg"
+    for i in range(0, FIXTURE_PACKAGES, 3):
+        for minor in range(FIXTURE_CACHED_VERSIONS):
+            _write(f"{cache}/pkg{i}-1.{i - minor}-1-x86_64.pkg.tar.zst", "p" * 4096)
+
+    _write(f"{root}/var/log/pacman.log", "log line\n" * (FIXTURE_LOG_BYTES // 9))
+    _write(f"{root}/var/log/Xorg.0.log.old.1", "old\n")
+    _write(f"{root}/var/log/journal/.keep")
+    _write(f"{root}/var/lib/systemd/coredump/core.bench.1234.zst", "c" * 65536)
+    _write(f"{root}/tmp/.keep")
+    _write(f"{root}/var/tmp/.keep")
+    _write(f"{root}/etc/pacman.d/mirrorlist", RANKED_MIRRORS)
+    metadata = f"{root}/var/lib/fwupd/metadata/lvfs/firmware.xml.zst"
+    _write(metadata, "metadata")
+    two_days_ago = time.time() - 2 * 86400
+    os.utime(metadata, (two_days_ago, two_days_ago))
+    _write(
+        f"{root}/crucial/pkglist.txt",
+        "".join(f"pkg{i}\n" for i in range(0, FIXTURE_PACKAGES, 10)),
+    )
+    _write(f"{root}/crucial/ExplicitPkg_list.txt", "pkg1\n")
+    _write(f"{root}/answers.json", json.dumps(ANSWERS, indent=2) + "\n")
+
+
+def configure(module, root, server_url, constants=None):
+    """Point every path constant of FullUpgrade into the sandbox"""
+    state = f"{root}/var/lib/fullupgrade"
+    cache = f"{root}/var/cache/fullupgrade"
+    overrides = {
+        "PACMAN_D": f"{root}/etc/pacman.d",
+        "ARCH_MIRRORLIST_URL": f"{server_url}/mirrorlist",
+        "AUR_RPC_URL": f"{server_url}/rpc/v5/info",
+        "AUR_CACHE": f"{cache}/aur-info.json",
+        "CACHE_DIR": cache,
+        "MIRRORLIST_CACHE": f"{cache}/mirrorlist.all",
+        "MIRROR_RANKER": "rankmirrors",
+        "STATE_DIR": state,
+        "MIRROR_HISTORY_DB": f"{state}/mirrors.sqlite3",
+        "PACMAN_LOCAL_DB": f"{root}/var/lib/pacman/local",
+        "MISSING_FILES_REPORT": f"{root}/tmp/missing_files_report.txt",
+        "PKG_CACHE_DIR": f"{root}/var/cache/pacman/pkg",
+        "LOG_ROOT": f"{root}/var/log",
+        "JOURNAL_DIR": f"{root}/var/log/journal",
+        "CLEANUP_POLICIES": [
+            {"name": "coredumps", "dirs": [f"{root}/var/lib/systemd/coredump"]},
+            {"name": "stale-var-tmp", "dirs": [f"{root}/var/tmp"], "min_age": 0},
+            {"name": "stale-tmp", "dirs": [f"{root}/tmp"], "min_age": 0},
+        ],
+        "MANIFEST_DIR": f"{root}/crucial",
+        "MANIFEST_SNAPSHOT": f"{state}/manifest.json",
+        "PERF_DIR": f"{state}/perf",
+        "REFRESH_STATE": f"{state}/refresh.json",
+        "RUN_JOURNAL": f"{state}/journal.json",
+        "CHECKUPDATES_DB": f"{cache}/checkup-db",
+        "FWUPD_METADATA_DIR": f"{root}/var/lib/fwupd/metadata",
+        "ANSWERS_FILE": f"{root}/answers.json",
+        "LOG_DIR": f"{root}/var/log/fullupgrade",
+    }
+    for name, value in (constants or {}).items():
+        if isinstance(value, str):
+            value = value.replace("{root}", root)
+        overrides[name] = value
+    for name, value in overrides.items():
+        if not hasattr(module, name):
+            raise AttributeError(f"FullUpgrade has no constant {name}")
+        setattr(module, name, value)
+
+
+# ============================================================
+# SCENARIO RUNNER
+# ============================================================
+
+
+def _busy_seconds(calls):
+    """Length of the union of the stub invocation intervals"""
+    busy = 0.0
+    end = None
+    for call in sorted(calls, key=lambda c: c["start"]):
+        if end is None or call["start"] > end:
+            busy += call["end"] - call["start"]
+            end = call["end"]
+        elif call["end"] > end:
+            busy += call["end"] - end
+            end = call["end"]
+    return busy
+
+
+def load_script():
+    """Import FullUpgrade.py as a module"""
+    spec = importlib.util.spec_from_file_location("FullUpgrade", SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["FullUpgrade"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def check_vercmp(module):
+    """Check vercmp against VERCMP_VECTORS both ways; returns the failures"""
+    failures = []
+    for a, b, expected in VERCMP_VECTORS:
+        for x, y, want in ((a, b, expected), (b, a, -expected)):
+            got = module.vercmp(x, y)
+            if got != want:
+                failures.append(f"vercmp({x!r}, {y!r}) = {got}, expected {want}")
+    return failures
+
+
+def run_child(name, root, server_url, result_path):
+    """Run main() for one scenario in this (fresh) process"""
+    scenario = SCENARIOS[name]
+    module = load_script()
+    configure(module, root, server_url, scenario.get("constants"))
+
+    json_log = f"{root}/run.jsonl"
+    start = time.monotonic()
+    started = time.time()
+    returncode = module.main(
+        ["--unattended", "--answers", f"{root}/answers.json", "--json-log", json_log]
+    )
+    wall = time.monotonic() - start
+
+    calls = []
+    calls_path = os.environ["FULLUPGRADE_BENCH_CALLS"]
+    if os.path.isfile(calls_path):
+        with open(calls_path, encoding="utf-8") as f:
+            calls = [json.loads(line) for line in f]
+    calls = [c for c in calls if c["start"] >= started]
+
+    errors = []
+    with open(json_log, encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if record.get("level") == "error":
+                errors.append(record.get("message", ""))
+
+    report = module._perf.report()
+    busy = _busy_seconds(calls)
+    result = {
+        "scenario": name,
+        "returncode": returncode,
+        "wall": wall,
+        "commands": len(calls),
+        "command_seconds": busy,
+        "overhead": wall - busy,
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "child_peak_rss": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        * 1024,
+        "scheduled": [p.name for p in module.upgrade_phases() if p.enabled],
+        "phases": report["phases"],
+        "errors": errors,
+    }
+    with open(result_path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=1)
+
+
+def run_scenario(name, server, keep=False):
+    """Build a sandbox and run one scenario in a child process"""
+    scenario = SCENARIOS[name]
+    root = tempfile.mkdtemp(prefix=f"fullupgrade-bench-{name}-")
+    try:
+        build_sandbox(root)
+        install_stubs(f"{root}/bin")
+        config_path = f"{root}/stubs.json"
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump(stub_config(scenario), f, indent=1)
+
+        server.status = scenario.get("mirrorlist", 200)
+        server.delay = scenario.get("mirror_delay", 0.0)
+        server.aur_newer = scenario.get("aur_newer", True)
+
+        env = dict(os.environ)
+        env["PATH"] = f"{root}/bin{os.pathsep}{env.get('PATH', '')}"
+        env["FULLUPGRADE_BENCH_STUBS"] = config_path
+        env["FULLUPGRADE_BENCH_CALLS"] = f"{root}/calls.jsonl"
+        result_path = f"{root}/result.json"
+
+        for _ in range(scenario.get("warm_runs", 0) + 1):
+            server.mirrorlist_replies.clear()
+            with open(f"{root}/output.txt", "w", encoding="utf-8") as output:
+                proc = subprocess.run(
+                    [
+                        sys.executable,
+                        __file__,
+                        "--child",
+                        name,
+                        root,
+                        server.url,
+                        result_path,
+                    ],
+                    env=env,
+                    stdin=subprocess.DEVNULL,
+                    stdout=output,
+                    stderr=subprocess.STDOUT,
+                    timeout=600,
+                )
+            if proc.returncode != 0 or not os.path.isfile(result_path):
+                with open(f"{root}/output.txt", encoding="utf-8") as f:
+                    tail = f.read()[-2000:]
+                raise RuntimeError(
+                    f"{name}: harness failed ({proc.returncode})\n{tail}"
+                )
+
+        with open(result_path, encoding="utf-8") as f:
+            result = json.load(f)
+        result["mirrorlist_replies"] = list(server.mirrorlist_replies)
+        result["sandbox"] = root if keep else None
+        return result
+    finally:
+        if not keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+# ============================================================
+# REPORT
+# ============================================================
+
+
+def _mib(size):
+    return f"{size / (1024 * 1024):.1f}M"
+
+
+def summarize(name, runs):
+    """Print one scenario's results, medians across repeats"""
+    wall = statistics.median(r["wall"] for r in runs)
+    overhead = statistics.median(r["overhead"] for r in runs)
+    rss = max(r["peak_rss"] for r in runs)
+    child_rss = max(r["child_peak_rss"] for r in runs)
+    last = runs[-1]
+    codes = sorted({r["returncode"] for r in runs})
+
+    print(f"\n{name}: {SCENARIOS[name]['description']}")
+    print(
+        f"  exit {'/'.join(map(str, codes))}, wall {wall:.2f}s, "
+        f"overhead {overhead:.2f}s, {last['commands']} commands, "
+        f"peak RSS {_mib(rss)} (commands {_mib(child_rss)})"
+    )
+    for phase, stats in sorted(last["phases"].items(), key=lambda p: -p[1]["wall"]):
+        print(f"    {phase:16} {stats['wall']:7.2f}s  CPU {stats['child_cpu']:.2f}s")
+    replies = last.get("mirrorlist_replies")
+    if replies:
+        print(f"    mirrorlist replies: {', '.join(map(str, replies))}")
+    missing = [p for p in last["scheduled"] if p not in last["phases"]]
+    if missing:
+        print(f"    not run: {', '.join(missing)}")
+    for message in last["errors"][:8]:
+        print(f"    error: {message.splitlines()[0] if message else ''}")
+    if len(last["errors"]) > 8:
+        print(f"    ... {len(last['errors']) - 8} more error(s)")
+    if last.get("sandbox"):
+        print(f"    sandbox kept at {last['sandbox']}")
+
+
+def parse_args(argv=None):
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "-s",
+        "--scenario",
+        action="append",
+        choices=sorted(SCENARIOS),
+        help="scenario to run (repeatable; default: all)",
+    )
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=1, help="runs per scenario"
+    )
+    parser.add_argument("--json", metavar="FILE", help="write raw results to FILE")
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the sandboxes for inspection"
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="list the scenarios and exit"
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Main entry point"""
+    args = parse_args(argv)
+    if args.list:
+        for name, scenario in SCENARIOS.items():
+            print(f"{name:16} {scenario['description']}")
+        return 0
+
+    failures = check_vercmp(load_script())
+    for failure in failures:
+        print(f"error: {failure}")
+    if failures:
+        return 1
+    print(f"vercmp: {len(VERCMP_VECTORS)} vectors ok")
+
+    results = {}
+    with MirrorServer() as server:
+        for name in args.scenario or list(SCENARIOS):
+            runs = [run_scenario(name, server, args.keep) for _ in range(args.repeat)]
+            results[name] = runs
+            summarize(name, runs)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 6 and sys.argv[1] == "--child":
+        run_child(*sys.argv[2:])
+        sys.exit(0)
+    sys.exit(main())